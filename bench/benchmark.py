@@ -0,0 +1,174 @@
+#! /usr/bin/env python3
+
+import json
+import platform
+import sys
+import tracemalloc
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
+
+import requests
+
+from libtifu.bitbucket import BitbucketAPIWrapper
+from libtifu.github import GithubAPIWrapper
+from libtifu.gitlab import GitlabAPIWrapper
+from libtifu.scan import Scanner
+from libtifu.server import RecoveryServer
+
+from .mockserver import EPOCH, create_server
+
+
+WRAPPERS = {
+    "bitbucket": BitbucketAPIWrapper,
+    "github": GithubAPIWrapper,
+    "gitlab": GitlabAPIWrapper,
+}
+
+# name, api, mock data, action
+SCENARIOS = [
+    ("github-repos-5k", "github", {"repos": 5000}, "repos"),
+    ("gitlab-repos-5k", "gitlab", {"repos": 5000}, "repos"),
+    ("gitlab-repos-5k-offset", "gitlab", {"repos": 5000, "offset_only": True}, "repos"),
+    ("gitlab-repos-5k-offset-no-total", "gitlab", {"repos": 5000, "offset_only": True, "omit_total": True}, "repos"),
+    ("github-events-3k", "github", {"events": 3000}, "events"),
+    ("gitlab-events-3k", "gitlab", {"events": 3000}, "events"),
+    ("github-events-3k-large", "github", {"events": 3000, "commits": 20, "message_size": 2000}, "events"),
+    ("bitbucket-repos-5k", "bitbucket", {"repos": 5000}, "repos"),
+    ("github-first-event-3k", "github", {"events": 3000}, "first_event"),
+    ("github-scan-100", "github", {"repos": 100, "events": 100}, "scan"),
+    ("gitlab-scan-100", "gitlab", {"repos": 100, "events": 100}, "scan"),
+    ("github-scan-100-rate-limited", "github", {"repos": 100, "events": 100, "rate_limit": 200, "rate_window": 2}, "scan"),
+    ("github-serve-300-clients", "github", {"repos": 10, "events": 100}, "serve"),
+]
+
+SERVE_CLIENTS = 300
+
+
+def consume(elements, result):
+    # Elements are consumed one by one to time the first of them.
+    start = perf_counter()
+    count = 0
+    for _ in elements:
+        if not count:
+            result["time_to_first"] = perf_counter() - start
+        count += 1
+    result["elements"] = count
+
+
+def serve(wrapper, data, result):
+    # A burst of clients listing the events of a few repositories, most of
+    # them waiting on a fetch already in flight.
+    server = RecoveryServer(wrapper, ("127.0.0.1", 0), quiet=True).start()
+    urls = [
+        "{}repos/mock/project-{}/events?limit=30".format(server.url, i % data.get("repos"))
+        for i in range(SERVE_CLIENTS)
+    ]
+
+    def get(url):
+        start = perf_counter()
+        requests.get(url).raise_for_status()
+        return perf_counter() - start
+
+    try:
+        with ThreadPoolExecutor(max_workers=SERVE_CLIENTS) as executor:
+            latencies = sorted(executor.map(get, urls))
+    finally:
+        server.stop()
+    result["elements"] = len(latencies)
+    result["latency_p50"] = latencies[len(latencies) // 2]
+    result["latency_p99"] = latencies[len(latencies) * 99 // 100]
+
+
+def run_action(wrapper, action, data, jobs, result):
+    if action == "repos":
+        consume(wrapper.get_repos(), result)
+    elif action == "events":
+        consume(wrapper.get_events(), result)
+    elif action == "first_event":
+        start = perf_counter()
+        events = wrapper.get_events()
+        next(events)
+        result["time_to_first"] = perf_counter() - start
+        events.close()
+    elif action == "scan":
+        # Like an on-call scan of the last half hour, with a push every
+        # minute.
+        since = EPOCH - timedelta(minutes=30)
+        repos = ["mock/project-{}".format(i) for i in range(data.get("repos"))]
+        consume(Scanner(wrapper, since, jobs=jobs).scan(repos), result)
+    elif action == "serve":
+        serve(wrapper, data, result)
+
+
+def run_scenario(name, api, data, action, latency, jobs):
+    data = dict(data)
+    server_options = {
+        "rate_limit": data.pop("rate_limit", None),
+        "rate_window": data.pop("rate_window", 60),
+        "omit_total": data.pop("omit_total", False),
+        "offset_only": data.pop("offset_only", False),
+    }
+    server = create_server(api, latency, **server_options, **data).start()
+    try:
+        wrapper = WRAPPERS[api](
+            "mock/project-0", "127.0.0.1", api_url=server.url, jobs=jobs,
+        )
+        # Rate limiters are shared by credentials, keep scenarios apart.
+        wrapper.creds = ("bench", name) if api != "gitlab" else name
+        result = {"scenario": name, "api": api, "action": action}
+        tracemalloc.start()
+        start = perf_counter()
+        run_action(wrapper, action, data, jobs, result)
+        result["wall_time"] = perf_counter() - start
+        result["peak_memory"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        result.update(server.stats)
+    finally:
+        server.stop()
+    return result
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark the API wrappers against mock providers.")
+    parser.add_argument(
+        "scenarios", nargs="*", metavar="SCENARIO",
+        help="scenarios to run (default: all)",
+    )
+    parser.add_argument("--latency", type=float, default=20, metavar="MS",
+                        help="mock server latency (default: %(default)s)")
+    parser.add_argument("-j", "--jobs", type=int, default=4, metavar="N",
+                        help="wrapper jobs (default: %(default)s)")
+    parser.add_argument("-o", "--output", default="-", metavar="FILE",
+                        help="JSON report file (default: stdout)")
+    parser.add_argument("-l", "--list", action="store_true",
+                        help="list scenarios and exit")
+    args = parser.parse_args()
+
+    if args.list:
+        for name, api, data, action in SCENARIOS:
+            print(name)
+        return
+
+    selected = [s for s in SCENARIOS if not args.scenarios or s[0] in args.scenarios]
+    results = []
+    for name, api, data, action in selected:
+        print("Running {}...".format(name), file=sys.stderr)
+        results.append(run_scenario(name, api, data, action, args.latency / 1000, args.jobs))
+
+    report = {
+        "date": datetime.now(timezone.utc).replace(tzinfo=None).isoformat(),
+        "python": platform.python_version(),
+        "latency": args.latency,
+        "jobs": args.jobs,
+        "results": results,
+    }
+    output = sys.stdout if args.output == "-" else open(args.output, "w")
+    with output:
+        json.dump(report, output, indent=2)
+        output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,687 @@
+#! /usr/bin/env python3
+
+import gzip
+import json
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from hashlib import sha1
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from math import ceil
+from re import findall, match
+from socket import IPPROTO_TCP, TCP_NODELAY
+from threading import Lock, Thread
+from time import sleep, time
+from urllib.parse import parse_qs, unquote, urlencode, urlparse
+
+
+APIS = ["github", "gitlab", "bitbucket"]
+EPOCH = datetime(2017, 1, 31, 12, 0, 0)
+
+
+def sha(*parts):
+    return sha1(":".join(str(part) for part in parts).encode()).hexdigest()
+
+
+class MockData():
+
+    def __init__(self, repos=10, events=300, commits=3, message_size=80,
+                 force_every=10, collect_every=0, erased_commits=1):
+        self.repos = repos
+        self.events = events
+        self.commits = commits
+        self.message_size = message_size
+        self.force_every = force_every
+        self.collect_every = collect_every
+        # Commits lost by each forced push.
+        self.erased_commits = erased_commits
+
+    def repo(self, i):
+        return "mock", "project-{}".format(i)
+
+    def head(self, repo, i):
+        # Heads are numbered from the most recent push.
+        return sha(repo, "head", i)
+
+    def is_forced(self, i):
+        return self.force_every and i % self.force_every == self.force_every - 1
+
+    def is_collected(self, i):
+        # The old head of every collect_every-th forced push is gone.
+        forced = i // self.force_every
+        return self.is_forced(i) and self.collect_every \
+            and forced % self.collect_every == self.collect_every - 1
+
+    def exists(self, repo, commit):
+        return not any(
+            self.is_collected(i) and commit == sha(repo, "erased", i)
+            for i in range(self.events)
+        )
+
+    def event_date(self, i):
+        return EPOCH - timedelta(minutes=i)
+
+    def message(self, repo, i, j):
+        title = "Commit {} of push {} in {}".format(j, i, repo)
+        return title + "\n\n" + "x" * max(self.message_size - len(title), 0)
+
+    def commit(self, repo, i, j):
+        # Commits of a push are listed from the oldest.
+        return {
+            "id": sha(repo, "commit", i, j),
+            "name": "Mock Author",
+            "email": "mock@example.com",
+            "message": self.message(repo, i, j),
+        }
+
+    def push(self, repo, i):
+        # The old head of a forced push is not an ancestor of its new head.
+        before = self.head(repo, i + 1)
+        if self.is_forced(i):
+            before = sha(repo, "erased", i)
+        return {
+            "before": before,
+            "after": self.head(repo, i),
+            "date": self.event_date(i),
+            "commits": [self.commit(repo, i, j) for j in range(self.commits)],
+        }
+
+    def erased(self, repo, before, after):
+        for i in range(self.events):
+            if self.is_forced(i) and before == sha(repo, "erased", i) \
+                    and after == self.head(repo, i):
+                return [
+                    self.commit(repo, "erased-{}".format(i), j)
+                    for j in range(self.erased_commits)
+                ]
+        return []
+
+
+class MockProvider():
+
+    # Sent with every response, as the real APIs do (see probe).
+    HEADERS = {}
+
+    def __init__(self, data):
+        self.data = data
+        self.refs = set()
+        self.lock = Lock()
+
+    def create_ref(self, repo, name):
+        # False when the ref already exists.
+        with self.lock:
+            if (repo, name) in self.refs:
+                return False
+            self.refs.add((repo, name))
+            return True
+
+    def page_bounds(self, query, total, default_size=30, max_size=100):
+        page = int(query.get("page", ["1"])[0])
+        size = min(int(query.get("per_page", [str(default_size)])[0]), max_size)
+        return page, size, max(ceil(total / size), 1)
+
+    def links(self, url, query, page, pages):
+        def link(page, rel):
+            params = dict((key, values[0]) for key, values in query.items())
+            params["page"] = page
+            return '<{}?{}>; rel="{}"'.format(url, urlencode(params), rel)
+        links = []
+        if page < pages:
+            links.append(link(page + 1, "next"))
+        links.append(link(pages, "last"))
+        return ", ".join(links)
+
+
+class GithubProvider(MockProvider):
+
+    RATELIMIT_HEADERS = (
+        "X-RateLimit-Remaining", "X-RateLimit-Reset", "X-RateLimit-Limit",
+    )
+    THROTTLED_CODE = 403
+    HEADERS = {"X-GitHub-Request-Id": "MOCK"}
+    # Commits listed by an unpaginated compare.
+    COMPARE_LIMIT = 250
+
+    def route(self, method, path, query, body, url):
+        data = self.data
+        if method == "GET" and path == "/user":
+            return 200, {}, {"login": "mock"}
+        if method == "POST" and path == "/graphql":
+            return self.graphql(json.loads(body.decode()))
+        if method == "GET" and path == "/user/repos":
+            page, size, pages = self.page_bounds(query, data.repos)
+            repos = [
+                {"owner": {"login": data.repo(i)[0]}, "name": data.repo(i)[1]}
+                for i in range((page - 1) * size, min(page * size, data.repos))
+            ]
+            return 200, {"Link": self.links(url, query, page, pages)}, repos
+        rem = match(
+            r"^/repos/([^/]+/[^/]+)/"
+            r"(events|compare/(\w+)\.\.\.(\w+)|git/refs|git/commits/(\w+))$",
+            path,
+        )
+        if not rem:
+            return 404, {}, {"message": "Not Found"}
+        repo = rem.group(1)
+        if method == "GET" and rem.group(2) == "events":
+            page, size, pages = self.page_bounds(query, data.events)
+            events = [
+                self.event(repo, i)
+                for i in range((page - 1) * size, min(page * size, data.events))
+            ]
+            return 200, {"Link": self.links(url, query, page, pages)}, events
+        if method == "GET" and rem.group(3):
+            # At most COMPARE_LIMIT commits unless paginated.
+            if not data.exists(repo, rem.group(4)):
+                return 404, {}, {"message": "Not Found"}
+            commits = data.erased(repo, rem.group(4), rem.group(3))
+            total = len(commits)
+            if "page" in query or "per_page" in query:
+                page, size, _ = self.page_bounds(query, total)
+                commits = commits[(page - 1) * size:page * size]
+            commits = commits[:self.COMPARE_LIMIT]
+            return 200, {}, {"total_commits": total, "commits": [
+                {
+                    "sha": commit.get("id"),
+                    "commit": {
+                        "author": {
+                            "name": commit.get("name"),
+                            "email": commit.get("email"),
+                        },
+                        "message": commit.get("message"),
+                    },
+                }
+                for commit in commits
+            ]}
+        if method == "GET" and rem.group(5):
+            if not data.exists(repo, rem.group(5)):
+                return 404, {}, {"message": "Not Found"}
+            return 200, {}, {"sha": rem.group(5)}
+        if method == "POST" and rem.group(2) == "git/refs":
+            ref = json.loads(body.decode())
+            if not self.create_ref(repo, ref.get("ref")):
+                return 422, {}, {"message": "Reference already exists"}
+            return 201, {}, ref
+        return 404, {}, {"message": "Not Found"}
+
+    def graphql(self, request):
+        # Only the repository, object and createRef fields used by the
+        # wrapper.
+        query = request.get("query")
+        variables = request.get("variables")
+        data = {}
+        errors = []
+        fields = findall(
+            r"(\w+): repository\(owner: \$(\w+), name: \$(\w+)\)"
+            r"( \{ object\(oid: \$(\w+)\))?",
+            query,
+        )
+        for alias, owner, name, _, oid in fields:
+            repo = "{}/{}".format(variables[owner], variables[name])
+            if not oid:
+                data[alias] = {"id": "R_" + repo}
+            elif self.data.exists(repo, variables[oid]):
+                data[alias] = {"object": {"id": "C_" + variables[oid]}}
+            else:
+                data[alias] = {"object": None}
+        for alias, name in findall(r"(\w+): createRef\(input: \$(\w+)\)", query):
+            ref = variables[name]
+            if self.create_ref(ref.get("repositoryId")[2:], ref.get("name")):
+                data[alias] = {"clientMutationId": None}
+                continue
+            data[alias] = None
+            errors.append({
+                "path": [alias],
+                "message": "A ref named \"{}\" already exists.".format(
+                    ref.get("name"),
+                ),
+            })
+        payload = {"data": data}
+        if errors:
+            payload["errors"] = errors
+        return 200, {}, payload
+
+    def event(self, repo, i):
+        push = self.data.push(repo, i)
+        return {
+            "id": str(10 ** 9 - i),
+            "type": "PushEvent",
+            "created_at": push.get("date").strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "payload": {
+                "ref": "refs/heads/master",
+                "before": push.get("before"),
+                "head": push.get("after"),
+                "commits": [
+                    {
+                        "sha": commit.get("id"),
+                        "author": {
+                            "name": commit.get("name"),
+                            "email": commit.get("email"),
+                        },
+                        "message": commit.get("message"),
+                    }
+                    for commit in push.get("commits")
+                ],
+            },
+        }
+
+
+class GitlabProvider(MockProvider):
+
+    RATELIMIT_HEADERS = ("RateLimit-Remaining", "RateLimit-Reset", "RateLimit-Limit")
+    THROTTLED_CODE = 429
+    HEADERS = {"X-Gitlab-Meta": '{"version": "1"}'}
+
+    def __init__(self, data, omit_total=False, offset_only=False):
+        super().__init__(data)
+        self.omit_total = omit_total
+        self.offset_only = offset_only
+
+    def keyset(self, url, query, total, build):
+        # Projects by decreasing id, project i having id total - i.
+        if self.offset_only:
+            return 400, {}, {
+                "message": "400 Bad request - pagination does not have a valid value",
+            }
+        size = min(int(query.get("per_page", ["20"])[0]), 100)
+        start = total - int(query.get("id_before", [str(total + 1)])[0]) + 1
+        end = min(start + size, total)
+        headers = {}
+        if end < total:
+            params = dict((key, values[0]) for key, values in query.items())
+            params["id_before"] = total - end + 1
+            headers["Link"] = '<{}?{}>; rel="next"'.format(url, urlencode(params))
+        return 200, headers, [dict(build(i), id=total - i) for i in range(start, end)]
+
+    def paginate(self, url, query, total, build):
+        page, size, pages = self.page_bounds(query, total, default_size=20)
+        headers = {"Link": self.links(url, query, page, pages)}
+        if page < pages:
+            headers["X-Next-Page"] = str(page + 1)
+        if not self.omit_total:
+            headers["X-Total-Pages"] = str(pages)
+        start = (page - 1) * size
+        return 200, headers, [build(i) for i in range(start, min(start + size, total))]
+
+    def event_bounds(self, query):
+        # Events of the days strictly between ?after and ?before.
+        data = self.data
+        first, last = 0, data.events
+        if "after" in query:
+            after = datetime.strptime(query["after"][0], "%Y-%m-%d").date()
+            while last > first and data.event_date(last - 1).date() <= after:
+                last -= 1
+        if "before" in query:
+            before = datetime.strptime(query["before"][0], "%Y-%m-%d").date()
+            while first < last and data.event_date(first).date() >= before:
+                first += 1
+        return first, last
+
+    def route(self, method, path, query, body, url):
+        data = self.data
+        if method == "GET" and path == "/user":
+            return 200, {}, {"username": "mock"}
+        if method == "GET" and path == "/projects":
+            paginate = self.paginate
+            if query.get("pagination") == ["keyset"]:
+                paginate = self.keyset
+            return paginate(url, query, data.repos, lambda i: {
+                "path_with_namespace": "/".join(data.repo(i)),
+            })
+        rem = match(
+            r"^/projects/([^/]+)/"
+            r"(events|repository/compare|repository/branches|repository/commits/(\w+))$",
+            path,
+        )
+        if not rem:
+            return 404, {}, {"message": "404 Not Found"}
+        repo = unquote(rem.group(1))
+        if method == "GET" and rem.group(2) == "events":
+            first, last = self.event_bounds(query)
+            return self.paginate(
+                url, query, last - first, lambda i: self.event(repo, first + i),
+            )
+        if method == "GET" and rem.group(2) == "repository/compare":
+            if not data.exists(repo, query["to"][0]):
+                return 404, {}, {"message": "404 Commit Not Found"}
+            commits = data.erased(repo, query["to"][0], query["from"][0])
+            return 200, {}, {"commits": [
+                {
+                    "id": commit.get("id"),
+                    "author_name": commit.get("name"),
+                    "author_email": commit.get("email"),
+                    "message": commit.get("message"),
+                }
+                for commit in commits
+            ]}
+        if method == "GET" and rem.group(3):
+            if not data.exists(repo, rem.group(3)):
+                return 404, {}, {"message": "404 Commit Not Found"}
+            return 200, {}, {"id": rem.group(3)}
+        if method == "POST" and rem.group(2) == "repository/branches":
+            branch = parse_qs(body.decode()).get("branch")[0]
+            if not self.create_ref(repo, branch):
+                return 400, {}, {"message": "Branch already exists"}
+            return 201, {}, {"name": branch}
+        return 404, {}, {"message": "404 Not Found"}
+
+    def event(self, repo, i):
+        push = self.data.push(repo, i)
+        head = push.get("commits")[-1]
+        return {
+            "id": 10 ** 9 - i,
+            "action_name": "pushed to",
+            "created_at": push.get("date").strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            "author": {"name": head.get("name"), "username": "mock"},
+            "push_data": {
+                "commit_count": len(push.get("commits")),
+                "action": "pushed",
+                "ref_type": "branch",
+                "commit_from": push.get("before"),
+                "commit_to": push.get("after"),
+                "ref": "master",
+                "commit_title": head.get("message").partition("\n")[0],
+            },
+        }
+
+
+def select_fields(value, fields):
+    # Bitbucket partial responses: "a.b" keeps value["a"]["b"], lists are
+    # traversed.
+    if isinstance(value, list):
+        return [select_fields(element, fields) for element in value]
+    if not isinstance(value, dict):
+        return value
+    paths = {}
+    for field in fields:
+        key, _, rest = field.partition(".")
+        paths.setdefault(key, []).append(rest)
+    return {
+        key: value[key] if "" in rests else select_fields(value[key], rests)
+        for key, rests in paths.items() if key in value
+    }
+
+
+class BitbucketProvider(MockProvider):
+
+    RATELIMIT_HEADERS = None
+    THROTTLED_CODE = 429
+
+    def page(self, url, query, total, build):
+        # Cursor pages, the next URL carries the page number.
+        size = min(int(query.get("pagelen", ["10"])[0]), 100)
+        page = int(query.get("page", ["1"])[0])
+        start = (page - 1) * size
+        end = min(start + size, total)
+        payload = {
+            "pagelen": size,
+            "page": page,
+            "values": [build(i) for i in range(start, end)],
+        }
+        if end < total:
+            params = dict((key, values[0]) for key, values in query.items())
+            params["page"] = page + 1
+            payload["next"] = "{}?{}".format(url, urlencode(params))
+        if "fields" in query:
+            payload = select_fields(payload, query["fields"][0].split(","))
+        return 200, {}, payload
+
+    def repository(self, i):
+        namespace, project = self.data.repo(i)
+        full_name = "{}/{}".format(namespace, project)
+        link = "https://bitbucket.org/{}".format(full_name)
+        return {
+            "type": "repository",
+            "full_name": full_name,
+            "name": project,
+            "slug": project,
+            "uuid": "{{{}}}".format(sha(full_name)[:32]),
+            "is_private": True,
+            "description": "Mock repository {}".format(i),
+            "language": "python",
+            "size": 1024 * i,
+            "created_on": EPOCH.isoformat(),
+            "updated_on": EPOCH.isoformat(),
+            "mainbranch": {"type": "branch", "name": "master"},
+            "owner": {
+                "type": "team",
+                "username": namespace,
+                "display_name": namespace,
+                "links": {"avatar": {"href": link + "/avatar"}},
+            },
+            "links": {
+                rel: {"href": "{}/{}".format(link, rel)}
+                for rel in [
+                    "self", "html", "avatar", "commits", "forks", "watchers",
+                    "downloads", "pullrequests", "branches", "tags", "hooks",
+                ]
+            },
+        }
+
+    def commit(self, commit):
+        return {
+            "type": "commit",
+            "hash": commit.get("id"),
+            "message": commit.get("message"),
+            "date": EPOCH.isoformat(),
+            "author": {
+                "raw": "{} <{}>".format(commit.get("name"), commit.get("email")),
+                "user": {"display_name": commit.get("name")},
+            },
+            "links": {"self": {"href": "https://bitbucket.org/"}},
+        }
+
+    def route(self, method, path, query, body, url):
+        data = self.data
+        if method == "GET" and path == "/user":
+            return 200, {}, {"username": "mock", "display_name": "Mock"}
+        if method == "GET" and path == "/repositories":
+            return self.page(url, query, data.repos, self.repository)
+        rem = match(
+            r"^/repositories/([^/]+/[^/]+)/(commit/(\w+)|commits/(\w+)|refs/branches)$",
+            path,
+        )
+        if not rem:
+            return 404, {}, {"type": "error", "error": {"message": "Not Found"}}
+        repo = rem.group(1)
+        if method == "GET" and rem.group(3):
+            if not data.exists(repo, rem.group(3)):
+                return 404, {}, {"type": "error", "error": {"message": "Not Found"}}
+            return 200, {}, {"hash": rem.group(3)}
+        if method == "GET" and rem.group(4):
+            if not data.exists(repo, rem.group(4)):
+                return 404, {}, {"type": "error", "error": {"message": "Not Found"}}
+            commits = data.erased(repo, rem.group(4), query.get("exclude", [""])[0])
+            return self.page(
+                url, query, len(commits), lambda i: self.commit(commits[i]),
+            )
+        if method == "POST" and rem.group(2) == "refs/branches":
+            branch = json.loads(body.decode())
+            if not self.create_ref(repo, branch.get("name")):
+                return 400, {}, {"type": "error", "error": {
+                    "message": "BRANCH_ALREADY_EXISTS",
+                }}
+            return 201, {}, branch
+        return 404, {}, {"type": "error", "error": {"message": "Not Found"}}
+
+
+PROVIDERS = {
+    "bitbucket": BitbucketProvider,
+    "github": GithubProvider,
+    "gitlab": GitlabProvider,
+}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        # Headers and body are written separately, do not let Nagle's
+        # algorithm add delayed ACK latency to every response.
+        super().setup()
+        self.request.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_request(self, method):
+        server = self.server
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if server.latency:
+            sleep(server.latency)
+        throttled, rate_headers = server.take_token()
+        if throttled:
+            status, headers, payload = (
+                server.provider.THROTTLED_CODE, {"Retry-After": "1"},
+                {"message": "API rate limit exceeded"},
+            )
+        else:
+            status, headers, payload = server.provider.route(
+                method, url.path, parse_qs(url.query), body,
+                "http://{}:{}{}".format(*server.server_address[:2], url.path),
+            )
+        headers.update(rate_headers)
+        headers.update(server.provider.HEADERS)
+        content = json.dumps(payload).encode()
+        etag = '"{}"'.format(sha(content))
+        if status == 200 and self.headers.get("If-None-Match") == etag:
+            status, content = 304, b""
+        if status == 200:
+            headers["ETag"] = etag
+        if content and "gzip" in self.headers.get("Accept-Encoding", ""):
+            content = gzip.compress(content)
+            headers["Content-Encoding"] = "gzip"
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+        server.count(method, status, len(content))
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_HEAD(self):
+        self.handle_request("HEAD")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+
+class MockServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, provider, address=("127.0.0.1", 0), latency=0,
+                 rate_limit=None, rate_window=60):
+        super().__init__(address, MockHandler)
+        self.provider = provider
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.lock = Lock()
+        self.window_start = time()
+        self.window_count = 0
+        self.stats = {}
+        self.reset_stats()
+
+    @property
+    def url(self):
+        return "http://{}:{}/".format(*self.server_address[:2])
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {"requests": 0, "bytes": 0, "throttled": 0, "methods": {}}
+
+    def count(self, method, status, size):
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["bytes"] += size
+            methods = self.stats["methods"]
+            methods[method] = methods.get(method, 0) + 1
+            if status == self.provider.THROTTLED_CODE:
+                self.stats["throttled"] += 1
+
+    def take_token(self):
+        if not self.rate_limit:
+            return False, {}
+        with self.lock:
+            now = time()
+            if now - self.window_start >= self.rate_window:
+                self.window_start = now
+                self.window_count = 0
+            self.window_count += 1
+            remaining = max(self.rate_limit - self.window_count, 0)
+            reset = int(self.window_start + self.rate_window)
+            throttled = self.window_count > self.rate_limit
+        headers = {}
+        if self.provider.RATELIMIT_HEADERS:
+            headers = dict(zip(
+                self.provider.RATELIMIT_HEADERS,
+                (str(remaining), str(reset), str(self.rate_limit)),
+            ))
+        return throttled, headers
+
+    def start(self):
+        thread = Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def create_server(api, latency=0, rate_limit=None, rate_window=60,
+                  address=("127.0.0.1", 0), omit_total=False, offset_only=False,
+                  **data):
+    data = MockData(**data)
+    if api == "gitlab":
+        provider = GitlabProvider(data, omit_total, offset_only)
+    else:
+        provider = PROVIDERS[api](data)
+    return MockServer(provider, address, latency, rate_limit, rate_window)
+
+
+def main():
+    parser = ArgumentParser(description="Serve a mock provider API.")
+    parser.add_argument("api", choices=APIS)
+    parser.add_argument("-p", "--port", type=int, default=8000)
+    parser.add_argument("--repos", type=int, default=10)
+    parser.add_argument("--events", type=int, default=300)
+    parser.add_argument("--commits", type=int, default=3, help="per push")
+    parser.add_argument("--message-size", type=int, default=80, metavar="BYTES")
+    parser.add_argument("--latency", type=float, default=0, metavar="MS")
+    parser.add_argument("--rate-limit", type=int, metavar="N")
+    parser.add_argument("--rate-window", type=float, default=60, metavar="SEC")
+    parser.add_argument("--collect-every", type=int, default=0, metavar="N",
+                        help="old head of every Nth forced push is gone")
+    parser.add_argument("--erased-commits", type=int, default=1, metavar="N",
+                        help="commits lost by each forced push")
+    parser.add_argument("--omit-total", action="store_true",
+                        help="no X-Total-Pages header (gitlab)")
+    parser.add_argument("--offset-only", action="store_true",
+                        help="refuse keyset pagination (gitlab)")
+    args = parser.parse_args()
+
+    server = create_server(
+        args.api, args.latency / 1000, args.rate_limit, args.rate_window,
+        ("127.0.0.1", args.port), args.omit_total, args.offset_only,
+        repos=args.repos,
+        events=args.events, commits=args.commits,
+        message_size=args.message_size, collect_every=args.collect_every,
+        erased_commits=args.erased_commits,
+    )
+    print("Serving mock {} API on {}".format(args.api, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+import asyncio
+from collections import deque
+from itertools import islice
+from json import loads
+from time import perf_counter
+
+import requests
+
+# Only needed by this module, the command line does not depend on it.
+try:
+    import aiohttp
+except ImportError:
+    raise ImportError(
+        "libtifu.aio needs aiohttp, install it with: pip3 install aiohttp"
+    )
+
+from .generics import DEFAULT_JOBS, APIException, copy_request
+from .session import DEFAULT_POOL_SIZE, DEFAULT_TIMEOUT
+from .stats import RequestRecord
+from .stream import STREAM_CHUNK_SIZE, ArrayDecoder
+
+
+def create_session(pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+    # One session per event loop, shared by all the wrappers: its
+    # connector is the connection pool. Bodies are streamed, the timeout
+    # applies to each read rather than to the whole response.
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=pool_size),
+        timeout=aiohttp.ClientTimeout(
+            total=None, connect=timeout, sock_read=timeout,
+        ),
+    )
+
+
+def to_response(prepared, raw, content):
+    # The provider methods (process_pagination, get_error...) read
+    # requests responses.
+    response = requests.Response()
+    response.status_code = raw.status
+    response.reason = raw.reason
+    response.headers.update(raw.headers)
+    response.url = str(raw.url)
+    response.request = prepared
+    response._content = content
+    response._content_consumed = True
+    response.raw = None
+    response.retries = 0
+    response.from_cache = False
+    response.cache_key = None
+    response.record = None
+    return response
+
+
+def close_page(page):
+    if not page.cancelled() and not page.exception() and page.result().raw:
+        page.result().raw.release()
+
+
+class AsyncAPIWrapper():
+
+    # Endpoints, prepare_* and filter_* come from a blocking wrapper of the
+    # provider, only the requests are sent differently. Nothing prompts:
+    # the wrapper must already have its credentials, repositories and
+    # events are given to the methods.
+    def __init__(self, wrapper, session, jobs=DEFAULT_JOBS):
+        self.wrapper = wrapper
+        self.session = session
+        self.jobs = jobs
+
+    def for_repo(self, repo):
+        return AsyncAPIWrapper(self.wrapper.for_repo(repo), self.session, self.jobs)
+
+    async def send_request(self, request, expected_code, missing=False,
+                           stream=False):
+        # Like AbstractAPIWrapper.send_request, the rate limiter being
+        # waited for without blocking the loop.
+        wrapper = self.wrapper
+        wrapper.prepare_creds(request)
+        prepared = wrapper.session.prepare_request(request)
+        limiter = wrapper.limiter
+        for attempt in range(wrapper.retries + 1):
+            delay = limiter.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            start = perf_counter()
+            try:
+                raw = await self.session.request(
+                    prepared.method, prepared.url, data=prepared.body,
+                    headers=dict(prepared.headers),
+                )
+                elapsed = perf_counter() - start
+                streamed = stream and raw.status == expected_code
+                content = b"" if streamed else await raw.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise APIException(e)
+            response = to_response(prepared, raw, content)
+            if wrapper.RATELIMIT_HEADERS:
+                limiter.update(*(
+                    response.headers.get(header)
+                    for header in wrapper.RATELIMIT_HEADERS
+                ))
+            delay = None if streamed else wrapper.get_retry_delay(response, attempt)
+            if delay is None or attempt == wrapper.retries:
+                break
+            raw.release()
+            limiter.block(delay)
+        response.retries = attempt
+        if wrapper.observers:
+            record = RequestRecord(
+                prepared.method, prepared.url, response.status_code, start,
+                perf_counter() - start, elapsed, len(content), attempt, False,
+            )
+            if streamed:
+                response.record = record
+            else:
+                wrapper.notify("on_request", record)
+        if streamed:
+            response.raw = raw
+        if missing and response.status_code in wrapper.MISSING_CODES:
+            return response
+        if response.status_code != expected_code:
+            raise APIException(wrapper.get_error(response), response.status_code)
+        return response
+
+    async def send_page(self, request, page):
+        request = copy_request(request)
+        request.method = "GET"
+        self.wrapper.prepare_page(request, page)
+        return await self.send_request(
+            request, requests.codes.ok, stream=not self.wrapper.PAGE_ITEMS,
+        )
+
+    async def get_page(self, request, page):
+        try:
+            return await self.send_page(request, page)
+        except APIException as e:
+            if not self.wrapper.retry_page(request, e):
+                raise
+        return await self.send_page(request, page)
+
+    async def get_next_page(self, request, url):
+        request = copy_request(request)
+        request.method = "GET"
+        request.url = url
+        request.params = {}
+        return await self.send_request(
+            request, requests.codes.ok, stream=not self.wrapper.PAGE_ITEMS,
+        )
+
+    async def decode_items(self, response):
+        if self.wrapper.PAGE_ITEMS:
+            for element in loads(response.content).get(self.wrapper.PAGE_ITEMS):
+                yield element
+            return
+        # Array pages are decoded one element at a time, as in
+        # AbstractAPIWrapper.decode_items.
+        array = ArrayDecoder()
+        record = response.record
+        try:
+            while True:
+                start = perf_counter()
+                chunk = await response.raw.content.read(STREAM_CHUNK_SIZE)
+                if record:
+                    record.duration += perf_counter() - start
+                    record.size += len(chunk)
+                for element in array.feed(chunk, not chunk):
+                    yield element
+                if not chunk:
+                    return
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise APIException(e)
+        finally:
+            response.raw.release()
+            if record:
+                self.wrapper.notify("on_request", record)
+
+    async def get_pages(self, request, pages):
+        # At most one page per job in flight, as in the blocking wrapper.
+        pages = iter(pages)
+        pending = deque(
+            asyncio.ensure_future(self.get_page(request, i))
+            for i in islice(pages, self.jobs)
+        )
+        try:
+            while pending:
+                response = await pending.popleft()
+                for i in islice(pages, 1):
+                    pending.append(asyncio.ensure_future(self.get_page(request, i)))
+                async for element in self.decode_items(response):
+                    yield element
+        finally:
+            for page in pending:
+                if not page.cancel():
+                    page.add_done_callback(close_page)
+
+    async def get_all_pages(self, request):
+        response = await self.get_page(request, 1)
+        page_count, next_url = self.wrapper.process_pagination(response)
+        async for element in self.decode_items(response):
+            yield element
+        if page_count:
+            async for element in self.get_pages(request, range(2, page_count + 1)):
+                yield element
+            return
+        while next_url:
+            response = await self.get_next_page(request, next_url)
+            page_count, next_url = self.wrapper.process_pagination(response)
+            async for element in self.decode_items(response):
+                yield element
+
+    async def get_user(self):
+        request = self.wrapper.request(self.wrapper.USER_ENDPOINT, "GET")
+        response = await self.send_request(request, requests.codes.ok)
+        return self.wrapper.filter_user(loads(response.content))
+
+    async def get_repos(self):
+        wrapper = self.wrapper
+        request = wrapper.request(wrapper.REPOS_ENDPOINT)
+        wrapper.prepare_repos(request)
+        if wrapper.owned and wrapper.OWNED_PARAMS:
+            request.params.update(wrapper.OWNED_PARAMS)
+        user = None
+        if wrapper.owned and not wrapper.OWNED_PARAMS:
+            user = await self.get_user()
+        async for element in self.get_all_pages(request):
+            for repo in wrapper.filter_repos([element]):
+                if not user or repo.namespace == user:
+                    yield repo
+
+    async def get_events(self, since=None, until=None):
+        # Events are filtered one by one as their page is decoded, with
+        # the same bounds and matches as AbstractAPIWrapper.get_events.
+        wrapper = self.wrapper
+        if not wrapper.EVENTS_ENDPOINT:
+            # Raises the error of the provider.
+            wrapper.fetch_events(since, until)
+        request = wrapper.request(wrapper.EVENTS_ENDPOINT)
+        wrapper.prepare_events(request, since, until)
+        async for element in self.get_all_pages(request):
+            for event in wrapper.filter_events([element]):
+                if until and event.date > until:
+                    continue
+                if since and event.date < since:
+                    return
+                if wrapper.match_event(event):
+                    yield event
+
+    async def create_branch(self, branch, ref):
+        request = self.wrapper.request(self.wrapper.CREATE_BRANCH_ENDPOINT, "POST")
+        self.wrapper.prepare_create_branch(request, branch, ref)
+        await self.send_request(request, requests.codes.created)
+
+    async def commit_exists(self, sha):
+        # Answers are shared with the blocking wrapper and its copies.
+        wrapper = self.wrapper
+        key = (str(wrapper.repo), sha)
+        if key in wrapper.reachable:
+            return wrapper.reachable[key]
+        if not wrapper.COMMITS_ENDPOINT:
+            return True
+        request = wrapper.request("/".join([wrapper.COMMITS_ENDPOINT, sha]), "GET")
+        wrapper.prepare_commit(request)
+        response = await self.send_request(request, requests.codes.ok, missing=True)
+        wrapper.reachable[key] = response.status_code == requests.codes.ok
+        return wrapper.reachable[key]
+
+    async def load_erased(self, event):
+        # Compares are provider specific and cached by the blocking
+        # wrapper, they run in the default executor.
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.wrapper.load_erased, event,
+        )
+
+    async def is_force_push(self, event):
+        await self.load_erased(event)
+        return bool(event.erased)
+
+    async def find_recovery(self, event):
+        # The old head first, then the erased commits concurrently.
+        candidates = self.wrapper.recovery_candidates(event)
+        if not candidates:
+            return False
+        if await self.commit_exists(candidates[0]):
+            return candidates[0]
+        found = await asyncio.gather(*(
+            self.commit_exists(sha) for sha in candidates[1:]
+        ))
+        return next(
+            (sha for sha, exists in zip(candidates[1:], found) if exists), False,
+        )
+
+    async def restore(self, event, branch=None):
+        # Selection is left to the caller: the event comes from get_events
+        # or anywhere else. Returns the created branch, pushes that erased
+        # nothing are refused.
+        await self.load_erased(event)
+        if event.erased == []:
+            raise APIException("This push did not erase any commit.")
+        if event.recovery is None:
+            event.recovery = await self.find_recovery(event)
+        if not event.recovery:
+            raise APIException(
+                "No commit of this push is left, they may have been "
+                "garbage collected."
+            )
+        branch = branch or "tifu-{}".format(event.recovery)
+        await self.create_branch(branch, event.recovery)
+        return branch
@@ -0,0 +1,210 @@
+import os
+import sqlite3
+from threading import Lock
+
+from .defaults import DEFAULT_ARCHIVE_PATH
+from .generics import Commit, PushEvent, event_marker
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    host TEXT NOT NULL,
+    repo TEXT NOT NULL,
+    marker TEXT NOT NULL,
+    ref TEXT,
+    before TEXT,
+    after TEXT,
+    date TEXT NOT NULL,
+    UNIQUE (host, repo, marker)
+);
+CREATE INDEX IF NOT EXISTS events_date ON events (host, repo, date);
+CREATE INDEX IF NOT EXISTS events_ref ON events (host, repo, ref, date);
+CREATE INDEX IF NOT EXISTS events_before ON events (before);
+CREATE INDEX IF NOT EXISTS events_after ON events (after);
+CREATE TABLE IF NOT EXISTS commits (
+    event INTEGER NOT NULL REFERENCES events (id),
+    position INTEGER NOT NULL,
+    sha TEXT NOT NULL,
+    author_name TEXT,
+    author_email TEXT,
+    message TEXT,
+    PRIMARY KEY (event, position)
+);
+CREATE INDEX IF NOT EXISTS commits_sha ON commits (sha);
+CREATE TABLE IF NOT EXISTS boundaries (
+    host TEXT NOT NULL,
+    repo TEXT NOT NULL,
+    event INTEGER NOT NULL REFERENCES events (id),
+    PRIMARY KEY (host, repo)
+);
+"""
+
+EVENT_COLUMNS = "id, ref, before, after, date, marker"
+
+
+def is_listed_after(row, other):
+    # Rows are (id, date), listed by date from the most recent, then by id.
+    id, date = row
+    other_id, other_date = other
+    return date < other_date or (date == other_date and id >= other_id)
+
+
+def sha_range(column):
+    # Hexadecimal prefixes as a range, so that the index is used.
+    return "({0} >= ? AND {0} < ?)".format(column)
+
+
+class EventArchive():
+
+    def __init__(self, path=DEFAULT_ARCHIVE_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Shared by the threads scanning repositories, one at a time.
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = Lock()
+        with self.lock:
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def find(self, host, repo, marker):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT id, date FROM events "
+                "WHERE host = ? AND repo = ? AND marker = ?",
+                (host, repo, marker),
+            ).fetchone()
+        return row
+
+    def boundary(self, host, repo):
+        # Every event listed after the boundary was archived.
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT events.id, events.date FROM boundaries "
+                "JOIN events ON events.id = boundaries.event "
+                "WHERE boundaries.host = ? AND boundaries.repo = ?",
+                (host, repo),
+            ).fetchone()
+        return row
+
+    def set_boundary(self, host, repo, id):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO boundaries (host, repo, event) "
+                "VALUES (?, ?, ?)",
+                (host, repo, id),
+            )
+
+    def store(self, host, repo, event):
+        with self.lock:
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO events "
+                "(host, repo, marker, ref, before, after, date) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    host, repo, event_marker(event), event.ref, event.before,
+                    event.after, event.date.isoformat(),
+                ),
+            )
+            if not cursor.rowcount:
+                return
+            self.connection.executemany(
+                "INSERT INTO commits "
+                "(event, position, sha, author_name, author_email, message) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    (
+                        cursor.lastrowid, position, commit.id,
+                        commit.author_name, commit.author_email,
+                        commit.raw_message,
+                    )
+                    for position, commit in enumerate(event.commits)
+                ),
+            )
+            return cursor.lastrowid
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+    def update(self, host, repo, events):
+        # Live events are stored until one of them is at or after the
+        # boundary, the older ones are then read from the archive rather
+        # than fetched again. Events the caller did not consume are not
+        # stored: the boundary only moves to the most recent event once
+        # the live events reached it, or ran out, without a gap.
+        boundary = self.boundary(host, repo)
+        newest = None
+        try:
+            for event in events:
+                known = self.find(host, repo, event_marker(event))
+                if not known:
+                    known = self.store(host, repo, event), event.date.isoformat()
+                newest = newest or known
+                if boundary and is_listed_after(known, boundary):
+                    break
+                yield event
+            else:
+                if not newest:
+                    return
+                # More pushes than the API keeps: the archived events older
+                # than the last live one still follow.
+                self.set_boundary(host, repo, newest[0])
+                self.commit()
+                id, date = known
+                yield from self.query(host, repo, start=(id + 1, date))
+                return
+            events.close()
+            self.set_boundary(host, repo, newest[0])
+            self.commit()
+            yield from self.query(host, repo, start=known)
+        finally:
+            self.commit()
+
+    def load_commits(self, id):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT sha, author_name, author_email, message FROM commits "
+                "WHERE event = ? ORDER BY position",
+                (id,),
+            ).fetchall()
+        return [Commit(*row) for row in rows]
+
+    def query(self, host, repo, since=None, ref=None, sha=None, start=None,
+              until=None):
+        # Events are listed from the most recent one, as by the APIs.
+        conditions = ["host = ?", "repo = ?"]
+        params = [host, repo]
+        if start:
+            id, date = start
+            conditions.append("(date < ? OR (date = ? AND id >= ?))")
+            params += [date, date, id]
+        if since:
+            conditions.append("date >= ?")
+            params.append(since.isoformat())
+        if until:
+            conditions.append("date <= ?")
+            params.append(until.isoformat())
+        if ref:
+            conditions.append("ref IN (?, ?)")
+            params += [ref, "refs/heads/{}".format(ref)]
+        if sha:
+            bounds = [sha, sha + "g"]
+            conditions.append(
+                "({} OR {} OR id IN (SELECT event FROM commits WHERE {}))".format(
+                    sha_range("before"), sha_range("after"), sha_range("sha"),
+                ),
+            )
+            params += bounds * 3
+        query = "SELECT {} FROM events WHERE {} ORDER BY date DESC, id".format(
+            EVENT_COLUMNS, " AND ".join(conditions),
+        )
+        with self.lock:
+            rows = self.connection.execute(query, params).fetchall()
+        for id, ref, before, after, date, marker in rows:
+            event_id = None if ":" in marker else marker
+            yield PushEvent(
+                ref, before, after, date, self.load_commits(id), event_id,
+            )
@@ -1,41 +1,45 @@
-from datetime import datetime
 from getpass import getpass
 from json import JSONDecodeError
-from urllib.parse import urljoin
+from re import match
 
-import requests
-
-from .generics import AbstractAPIWrapper, Commit, PushEvent, Repo
+from .generics import APIException, AbstractAPIWrapper, Commit, Repo
 
 
 class BitbucketAPIWrapper(AbstractAPIWrapper):
 
     DEFAULT_HOST = "bitbucket.org"
     USER_ENDPOINT = "user"
-    REPOS_ENDPOINT = "user/repositories"
-    EVENTS_HEADER = "Select the most recent push event containing your " \
-                    "erased commits:"
+    REPOS_ENDPOINT = "repositories"
+    # API 2.0 has no events, push changes only come with webhooks.
+    EVENTS_ENDPOINT = None
+    EVENTS_ERROR = "Bitbucket API 2.0 does not list push events."
+    PER_PAGE = 100
+    PAGE_ITEMS = "values"
+    OWNED_PARAMS = {"role": "member"}
+    # Partial responses, only what the filter_* methods read.
+    REPOS_FIELDS = "next,values.full_name"
+    COMMITS_FIELDS = "next,values.hash,values.message,values.author.raw"
 
     @property
     def API_URL(self):
-        return "https://api.{}/1.0/".format(self.host)
+        return "https://api.{}/2.0/".format(self.host)
 
     @property
     def REPO_BRANCH_URL(self):
         return "https://{}/{}/branch/{}".format(self.host, self.repo, self.branch)
 
     @property
-    def EVENTS_ENDPOINT(self):
-        return "/".join(["repositories", str(self.repo), "events"])
+    def CREATE_BRANCH_ENDPOINT(self):
+        return "/".join(["repositories", str(self.repo), "refs", "branches"])
 
     @property
-    def CREATE_BRANCH_ENDPOINT(self):
-        return "/".join(["branch", "create"])
+    def COMMITS_ENDPOINT(self):
+        return "/".join(["repositories", str(self.repo), "commit"])
 
     @property
     def AUTH_METHODS(self):
         return [
-            ("basic", self.auth_basic, "Basic (login + password)"),
+            ("basic", self.auth_basic, "Basic (login + app password)"),
         ]
 
     def get_error(self, response):
@@ -49,79 +53,73 @@ class BitbucketAPIWrapper(AbstractAPIWrapper):
         request.auth = self.creds
 
     def prepare_page(self, request, page):
-        # Bitbucket API does not use pagination for repository list
-        # and event endpoint is capped at 31 events. Set limit at 50
-        # so we always have one page.
-        request.params["limit"] = 50
+        # Further pages are only reached through the next cursor.
+        request.params["pagelen"] = str(self.PER_PAGE)
+
+    def prepare_repos(self, request):
+        # Without a role, every public repository would be listed.
+        request.params["role"] = "member"
+        request.params["fields"] = self.REPOS_FIELDS
 
     def prepare_create_branch(self, request, branch, ref):
-        request.data = {
-            "repository": str(self.repo),
-            "from_branch": ref,
-            "branch_name": branch,
-        }
+        request.json = {"name": branch, "target": {"hash": ref}}
 
-    def process_page_count(self, response):
-        # We will never have more than one page (see prepare_page).
-        return 1
+    def process_pagination(self, response):
+        # Cursors are in the body, see get_all_pages.
+        return None, self.decode(response).get("next")
+
+    def get_all_pages(self, request):
+        response = self.get_page(request, 1)
+        while True:
+            page = self.decode(response)
+            yield from page.get(self.PAGE_ITEMS)
+            if not page.get("next"):
+                return
+            response = self.get_next_page(request, page.get("next"))
+
+    def prepare_commit(self, request):
+        request.params["fields"] = "hash"
 
     def filter_user(self, user):
-        return user.get("user").get("username")
+        return user.get("username") or user.get("nickname")
 
     def filter_repos(self, repos):
 
         def filter_repo(repo):
-            namespace = repo.get("owner")
-            project = repo.get("slug")
+            namespace, _, project = repo.get("full_name").partition("/")
             return Repo(namespace, project)
 
-        return [filter_repo(repo) for repo in repos]
+        return (filter_repo(repo) for repo in repos)
 
     def filter_commits(self, commits):
 
         def filter_commit(commit):
             id = commit.get("hash")
-            author_name = ""
-            author_email = ""
-            message = commit.get("description").split("\n")[0]
+            author = match(r"^(.*?)\s*<(.*)>$", commit.get("author").get("raw"))
+            author_name = author.group(1) if author else ""
+            author_email = author.group(2) if author else ""
+            message = commit.get("message")
             return Commit(id, author_name, author_email, message)
 
         return [filter_commit(commit) for commit in commits]
 
     def filter_events(self, events):
+        raise APIException(self.EVENTS_ERROR)
+
+    def fetch_events(self, since=None, until=None):
+        raise APIException(self.EVENTS_ERROR)
+
+    def poll_events(self, etag=None):
+        raise APIException(self.EVENTS_ERROR)
 
-        def filter_event(event):
-            description = event.get("description")
-            ref = description.get("ref")
-            before = None
-            created_on = event.get("created_on")
-            date = datetime.strptime(created_on, "%Y-%m-%dT%H:%M:%S")
-            commits = self.filter_commits(description.get("commits"))
-            after = commits[0].id
-            return PushEvent(ref, before, after, date, commits)
-
-        events = (event for event in events if event.get("event") == "pushed")
-        return [filter_event(event) for event in events]
-
-    def get_events(self):
-        request = self.request(self.EVENTS_ENDPOINT, "GET")
-        events = self.send_request(request, requests.codes.ok).json()
-        return self.filter_events(events.get("events"))
-
-    def create_branch(self, branch, ref):
-        # Bitbucket API does not provide a way to create branches.
-        # Directly use the website instead.
-        url = urljoin("https://{}/".format(self.host), self.CREATE_BRANCH_ENDPOINT)
-        request = requests.Request("POST", url)
-        self.prepare_create_branch(request, branch, ref)
-        self.send_request(request, requests.codes.ok)
-
-    def attach_old_ref(self):
-        branch = "tifu-{}".format(self.event.after)
-        self.create_branch(branch, self.event.after)
-        return branch
+    def get_erased_commits(self, before, after):
+        # Commits reachable from the old head but not from the new one.
+        endpoint = "/".join(["repositories", str(self.repo), "commits", before])
+        request = self.request(endpoint, "GET")
+        request.params = {"exclude": after, "fields": self.COMMITS_FIELDS}
+        return self.filter_commits(list(self.get_all_pages(request)))
 
     def auth_basic(self):
         login = input("Login: ")
-        password = getpass("Password: ")
+        password = getpass("App password: ")
         return (login, password)
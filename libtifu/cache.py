@@ -0,0 +1,221 @@
+import json
+import os
+from hashlib import sha256
+from threading import Lock, get_ident
+from time import time
+
+import requests
+
+from .defaults import DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE, DEFAULT_CACHE_TTL
+
+
+# Headers describing the encoding of the original transfer, the cached
+# body is stored already decoded.
+TRANSFER_HEADERS = ["content-encoding", "content-length", "transfer-encoding"]
+
+
+class CacheEntry():
+
+    def __init__(self, meta, body):
+        self.meta = meta
+        self.body = body
+
+    @property
+    def validators(self):
+        headers = {}
+        if self.meta.get("etag"):
+            headers["If-None-Match"] = self.meta.get("etag")
+        if self.meta.get("last_modified"):
+            headers["If-Modified-Since"] = self.meta.get("last_modified")
+        return headers
+
+
+class ResponseCache():
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, ttl=DEFAULT_CACHE_TTL,
+                 max_size=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = Lock()
+        self.size = None
+        os.makedirs(os.path.join(directory, "responses"), mode=0o700, exist_ok=True)
+
+    def key(self, request, creds):
+        # Credentials are part of the key since visible resources depend
+        # on them, only their digest ends up on disk.
+        digest = sha256()
+        for part in (request.method, request.url, repr(creds)):
+            digest.update(part.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, "responses", key)
+
+    def lookup(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                meta = json.loads(f.readline().decode())
+                body = f.read()
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return CacheEntry(meta, body)
+
+    def is_fresh(self, entry):
+        return time() - entry.meta.get("stored") < self.ttl
+
+    def response(self, entry, request, revalidation=None):
+        response = requests.Response()
+        response.status_code = entry.meta.get("status")
+        response.reason = entry.meta.get("reason")
+        response.headers.update(entry.meta.get("headers"))
+        response.url = entry.meta.get("url")
+        response.encoding = entry.meta.get("encoding")
+        response.request = request
+        response._content = entry.body
+        response._content_consumed = True
+        response.from_cache = True
+        response.retries = 0
+        response.cache_key = None
+        response.record = None
+        if revalidation is not None:
+            for name, value in revalidation.headers.items():
+                if name.lower() not in TRANSFER_HEADERS:
+                    response.headers[name] = value
+            response.elapsed = revalidation.elapsed
+            response.retries = revalidation.retries
+        return response
+
+    def is_cacheable(self, response):
+        return self.ttl or response.headers.get("ETag") \
+            or response.headers.get("Last-Modified")
+
+    def meta(self, response):
+        headers = {
+            name: value for name, value in response.headers.items()
+            if name.lower() not in TRANSFER_HEADERS
+        }
+        return {
+            "url": response.url,
+            "status": response.status_code,
+            "reason": response.reason,
+            "encoding": response.encoding,
+            "headers": headers,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "stored": time(),
+        }
+
+    def store(self, key, response):
+        if not self.is_cacheable(response):
+            return
+        self.write(key, self.meta(response), response.content)
+        self.added(len(response.content))
+
+    def tee(self, key, response, chunks):
+        # Streamed bodies are written to a temporary file while they are
+        # read, the entry is only replaced once the body is complete.
+        if not self.is_cacheable(response):
+            yield from chunks
+            return
+        path = self.path(key)
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), get_ident())
+        size = 0
+        try:
+            f = open(tmp_path, "wb")
+            f.write(json.dumps(self.meta(response)).encode())
+            f.write(b"\n")
+        except OSError:
+            f = self.discard(tmp_path)
+        complete = False
+        try:
+            for chunk in chunks:
+                if f:
+                    try:
+                        f.write(chunk)
+                    except OSError:
+                        f = self.discard(tmp_path, f)
+                size += len(chunk)
+                yield chunk
+            complete = True
+        finally:
+            if f and not complete:
+                self.discard(tmp_path, f)
+        if f:
+            try:
+                f.close()
+                os.replace(tmp_path, path)
+            except OSError:
+                self.discard(tmp_path)
+            else:
+                self.added(size)
+
+    def discard(self, tmp_path, f=None):
+        if f:
+            f.close()
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return None
+
+    def added(self, size):
+        with self.lock:
+            if self.size is None:
+                self.size = self.disk_size()
+            self.size += size
+            if self.size > self.max_size:
+                self.evict()
+
+    def refresh(self, key, entry):
+        entry.meta["stored"] = time()
+        self.write(key, entry.meta, entry.body)
+
+    def write(self, key, meta, body):
+        path = self.path(key)
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), get_ident())
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(json.dumps(meta).encode())
+                f.write(b"\n")
+                f.write(body)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+    def entries(self):
+        # Temporary files belong to writes still in progress, and entries
+        # may vanish while listed when another process evicts them.
+        entries = []
+        try:
+            listing = list(os.scandir(os.path.join(self.directory, "responses")))
+        except OSError:
+            return entries
+        for entry in listing:
+            if entry.name.endswith(".tmp"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def disk_size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        # Least recently used entries go first, lookups touch their file.
+        entries = self.entries()
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if self.size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.size -= size
@@ -0,0 +1,30 @@
+import os
+
+
+# Kept apart from the modules using them so that the command line can be
+# parsed without importing requests.
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 30
+DEFAULT_RETRIES = 3
+DEFAULT_JOBS = 4
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "tifu",
+)
+DEFAULT_CACHE_TTL = 0
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+DEFAULT_ARCHIVE_PATH = os.path.join(DEFAULT_CACHE_DIR, "events.sqlite")
+DEFAULT_HOSTS_PATH = os.path.join(DEFAULT_CACHE_DIR, "hosts.json")
+# Hosts no provider recognized are probed again after that.
+DEFAULT_UNDETECTED_TTL = 24 * 60 * 60
+
+DEFAULT_INTERVAL = 60
+
+DEFAULT_PORT = 8080
+DEFAULT_WORKERS = 16
+# Event lists are shared by the requests arriving in the meantime, the
+# providers refresh them at most once a minute anyway.
+DEFAULT_EVENTS_TTL = 5
+# Known commits and compares are forgotten after that, a long running
+# service would otherwise keep all of them.
+DEFAULT_COMMITS_TTL = 300
@@ -1,13 +1,117 @@
 from abc import ABC, abstractmethod, abstractproperty
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing, contextmanager
+from copy import copy
+from datetime import datetime, timedelta
+from itertools import dropwhile, islice, takewhile
+from json import dumps, loads
 from math import log10
+from os import environ
+from sys import intern, stderr
+from threading import local
+from time import perf_counter
 from urllib.parse import urljoin
 from textwrap import indent
 
 import requests
 
+from .defaults import DEFAULT_JOBS
+from .ratelimit import backoff, get_limiter
+from .search import SearchIndex
+from .session import (
+    DEFAULT_POOL_SIZE, DEFAULT_RETRIES, DEFAULT_TIMEOUT, create_session,
+)
+from .stats import PhaseRecord, RequestRecord
+from .stream import STREAM_CHUNK_SIZE, iter_array
+
+
+NULL_SHA = "0" * 40
+RETRY_STATUSES = [500, 502, 503, 504]
+IDEMPOTENT_METHODS = ["GET", "HEAD"]
+SECONDARY_RATELIMIT_DELAY = 60
+
+
+def copy_request(request):
+    # Pages may be fetched concurrently, each one needs its own params.
+    request = copy(request)
+    request.headers = dict(request.headers)
+    request.params = dict(request.params)
+    return request
+
+
+def close_page(page):
+    if not page.cancelled() and not page.exception():
+        page.result().close()
+
+
+def intern_sha(sha):
+    # The same commit is referenced by many events, keep a single copy.
+    return intern(sha) if sha else sha
+
+
+def parse_date(value):
+    # Fast path for the ISO 8601 dates sent by the APIs, about twice as
+    # fast as strptime. Dates are returned as naive UTC.
+    date = datetime(
+        int(value[0:4]), int(value[5:7]), int(value[8:10]),
+        int(value[11:13]), int(value[14:16]), int(value[17:19]),
+    )
+    zone = value[19:]
+    if zone.startswith("."):
+        fraction = zone[1:].rstrip("Z").split("+")[0].split("-")[0]
+        date = date.replace(microsecond=int(fraction[:6].ljust(6, "0")))
+        zone = zone[len(fraction) + 1:]
+    if zone and zone != "Z":
+        offset = timedelta(hours=int(zone[1:3]), minutes=int(zone[-2:]))
+        date = date - offset if zone[0] == "+" else date + offset
+    return date
+
+
+def ref_matches(event, ref):
+    return event.ref in [ref, "refs/heads/{}".format(ref)]
+
+
+def sha_matches(event, sha):
+    shas = [event.before, event.after] + [commit.id for commit in event.commits]
+    return any(value and value.startswith(sha) for value in shas)
+
+
+def report_commit(commit):
+    return {
+        "id": commit.id,
+        "author_name": commit.author_name,
+        "author_email": commit.author_email,
+        "message": commit.raw_message,
+    }
+
+
+def report_event(event):
+    return {
+        "id": event.id,
+        "ref": event.ref,
+        "before": event.before,
+        "after": event.after,
+        "date": event.date.isoformat(),
+        "recovery": event.recovery,
+        "commits": [report_commit(commit) for commit in event.commits],
+        "erased": [
+            report_commit(commit) for commit in event.erased
+        ] if isinstance(event.erased, list) else None,
+    }
+
+
+def event_marker(event):
+    # Not every API numbers its events.
+    if event.id is not None:
+        return str(event.id)
+    return "{}:{}".format(event.date.isoformat(), event.after)
+
 
 class Repo():
 
+    __slots__ = ("namespace", "project")
+
     def __init__(self, namespace, project):
         self.namespace = namespace
         self.project = project
@@ -18,11 +122,17 @@ class Repo():
 
 class Commit():
 
+    __slots__ = ("id", "author_name", "author_email", "raw_message")
+
     def __init__(self, id, author_name, author_email, message):
-        self.id = id
+        self.id = intern_sha(id)
         self.author_name = author_name
         self.author_email = author_email
-        self.message = message
+        self.raw_message = message
+
+    @property
+    def message(self):
+        return self.raw_message.partition("\n")[0]
 
     def __str__(self):
         s = "{} - {}".format(self.id[:8], self.message)
@@ -33,21 +143,57 @@ class Commit():
 
 class PushEvent():
 
-    def __init__(self, ref, before, after, date, commits):
+    __slots__ = (
+        "ref", "before", "after", "raw_date", "commits", "id", "recovery",
+        "erased",
+    )
+
+    def __init__(self, ref, before, after, date, commits, id=None):
+        self.id = id
+        # Commit to restore, False when none is left (see verify_events).
+        self.recovery = None
+        # Commits lost by the push, from the newest, False when they could
+        # not be compared (see load_erased). The commits of the payload are
+        # the pushed ones, and may be truncated.
+        self.erased = None
         self.ref = ref
-        self.before = before
-        self.after = after
-        self.date = date
+        self.before = intern_sha(before)
+        self.after = intern_sha(after)
+        self.raw_date = date
         self.commits = commits
 
+    @property
+    def date(self):
+        # Providers hand over the raw date, only parse it when used.
+        if isinstance(self.raw_date, str):
+            self.raw_date = parse_date(self.raw_date)
+        return self.raw_date
+
     def __str__(self):
         return "[{}] {} -> {} @ {}".format(
             self.ref, self.before[:8], self.after[:8], self.date,
         )
 
 
+class RestoreTarget():
+
+    __slots__ = ("repo", "sha", "branch")
+
+    def __init__(self, repo, sha, branch=None):
+        self.repo = repo
+        self.sha = sha
+        self.branch = branch or "tifu-{}".format(sha)
+
+    def __str__(self):
+        return "{}@{} -> {}".format(self.repo, self.sha[:8], self.branch)
+
+
 class APIException(Exception):
-    pass
+
+    # status is the HTTP status of the refused request, if any.
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
 
 
 class AbstractAPIWrapper(ABC):
@@ -101,7 +247,7 @@ class AbstractAPIWrapper(ABC):
         pass
 
     @abstractmethod
-    def process_page_count(self, response):
+    def process_pagination(self, response):
         pass
 
     @abstractmethod
@@ -126,67 +272,588 @@ class AbstractAPIWrapper(ABC):
     REPOS_EMPTY = "No repositories."
     EVENTS_HEADER = "Select the push event that erased your commits:"
     EVENTS_EMPTY = "No push events."
+    FIND_EMPTY = "No push events match your search."
+    PICK_EMPTY = "No force push matches your pick."
+    SELECT_BATCH = 20
+    RATELIMIT_HEADERS = None
+    POLL_INTERVAL_HEADER = None
+    # Query parameters restricting repositories to the user's ones, they
+    # are filtered by owner otherwise.
+    OWNED_PARAMS = None
+    COMMITS_ENDPOINT = None
+    MISSING_CODES = [404]
+    # Key of the elements in pages, None when pages are arrays.
+    PAGE_ITEMS = None
+    # Endpoint answering without credentials, with a header only sent by
+    # the provider: recognizes self-hosted instances.
+    PROBE_ENDPOINT = None
+    PROBE_HEADER = None
+    # Environment variables holding the credentials of each auth method,
+    # used instead of prompting when they are all set.
+    AUTH_ENV = {
+        "basic": ("TIFU_LOGIN", "TIFU_PASSWORD"),
+        "oauth": ("TIFU_TOKEN",),
+        "token": ("TIFU_TOKEN",),
+    }
 
-    def __init__(self, repo, host):
+    def __init__(self, repo, host, pool_size=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES,
+                 jobs=DEFAULT_JOBS, since=None, cache=None, api_url=None,
+                 verify=False, archive=None, offline=False, ref=None,
+                 sha=None, find=None, until=None, owned=False,
+                 output_format="text", pick=None, pick_ref=None,
+                 pick_sha=None, yes=False):
         self.repo = repo
         self.host = host or self.DEFAULT_HOST
+        # Overrides the URL derived from the host (proxies, local mocks).
+        self.api_url = api_url.rstrip("/") + "/" if api_url else None
+        self.timeout = timeout
+        self.retries = retries
+        self.jobs = jobs
+        self.since = since
+        self.until = until
+        self.owned = owned
+        self.cache = cache
+        self.verify = verify
+        self.archive = archive
+        # Events are only read from the archive.
+        self.offline = offline
+        self.ref = ref
+        self.sha = sha
+        # SHA prefix or words looked up in the listed events.
+        self.find = find
+        # "text" or "ndjson", one JSON object per line on stdout.
+        self.output_format = output_format
+        # The most recent event matching the pick options is restored
+        # without listing the events ("latest" matches any).
+        self.pick = pick
+        self.pick_ref = pick_ref
+        self.pick_sha = pick_sha
+        # Picked events are restored without confirmation.
+        self.yes = yes
+        # (repo, sha) -> whether the commit is still on the server.
+        self.reachable = {}
+        # (repo, old head, new head) -> erased commits.
+        self.compared = {}
+        self.session = create_session(max(pool_size, jobs), retries)
+        self.observers = []
+        self.phases = local()
         self.auth_method = None
         self.auth_fcn = None
         self.creds = None
         self.event = None
         self.branch = None
 
+    def for_repo(self, repo):
+        # The copy shares the session, cache and credentials.
+        wrapper = copy(self)
+        wrapper.repo = repo
+        wrapper.event = None
+        wrapper.branch = None
+        return wrapper
+
+    def add_observer(self, observer):
+        self.observers.append(observer)
+
+    def notify(self, event, record):
+        for observer in self.observers:
+            getattr(observer, event)(record)
+
+    @contextmanager
+    def phase(self, name):
+        # Phases nest, each one also reports its duration minus the one of
+        # its sub-phases so that time is not accounted twice.
+        if not self.observers:
+            yield
+            return
+        if not hasattr(self.phases, "stack"):
+            self.phases.stack = []
+        frame = [perf_counter(), 0]
+        self.phases.stack.append(frame)
+        try:
+            yield
+        finally:
+            self.phases.stack.pop()
+            start, children = frame
+            duration = perf_counter() - start
+            if self.phases.stack:
+                self.phases.stack[-1][1] += duration
+            self.notify("on_phase", PhaseRecord(
+                name, start, duration, duration - children,
+            ))
+
+    def timed(self, name, elements):
+        if not self.observers:
+            return elements
+        return self.iter_timed(name, iter(elements))
+
+    def iter_timed(self, name, elements):
+        while True:
+            with self.phase(name):
+                element = next(elements, StopIteration)
+            if element is StopIteration:
+                return
+            yield element
+
     def request(self, endpoint, method=None):
-        return requests.Request(method, url=urljoin(self.API_URL, endpoint))
+        api_url = self.api_url or self.API_URL
+        return requests.Request(method, url=urljoin(api_url, endpoint))
+
+    @property
+    def PROBE_URLS(self):
+        # API URLs a self-hosted instance may answer at.
+        return [self.API_URL]
+
+    def probe(self):
+        # Returns the API URL the provider answered at, None otherwise.
+        if not self.PROBE_ENDPOINT:
+            return None
+        for api_url in [self.api_url] if self.api_url else self.PROBE_URLS:
+            request = requests.Request(
+                "GET", url=urljoin(api_url, self.PROBE_ENDPOINT),
+            )
+            try:
+                response = self.session.send(
+                    self.session.prepare_request(request), timeout=self.timeout,
+                )
+            except requests.RequestException:
+                continue
+            response.close()
+            if self.PROBE_HEADER in response.headers:
+                return api_url
+        return None
+
+    @property
+    def limiter(self):
+        return get_limiter(self.host, self.creds)
+
+    def get_retry_delay(self, response, attempt):
+        status = response.status_code
+        retry_after = response.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit() and status in [
+                requests.codes.forbidden, requests.codes.too_many_requests,
+        ] + RETRY_STATUSES:
+            return int(retry_after) + backoff(0)
+        if status == requests.codes.too_many_requests:
+            return backoff(attempt)
+        if status == requests.codes.forbidden:
+            # The budget is exhausted, the limiter waits for its reset.
+            if self.limiter.remaining == 0:
+                return backoff(0)
+            # GitHub secondary rate limits are 403 without Retry-After.
+            if "rate limit" in response.text.lower():
+                return SECONDARY_RATELIMIT_DELAY + backoff(attempt)
+            return None
+        if status in RETRY_STATUSES and response.request.method in IDEMPOTENT_METHODS:
+            return backoff(attempt)
+        return None
+
+    def send(self, prepared, stream=False):
+        limiter = self.limiter
+        for attempt in range(self.retries + 1):
+            limiter.acquire()
+            try:
+                response = self.session.send(
+                    prepared, timeout=self.timeout, stream=stream,
+                )
+            except requests.RequestException as e:
+                raise APIException(e)
+            if self.RATELIMIT_HEADERS:
+                limiter.update(*(
+                    response.headers.get(header)
+                    for header in self.RATELIMIT_HEADERS
+                ))
+            delay = self.get_retry_delay(response, attempt)
+            if delay is None or attempt == self.retries:
+                response.retries = attempt
+                response.from_cache = False
+                response.cache_key = None
+                response.record = None
+                return response
+            response.close()
+            limiter.block(delay)
+
+    def fetch(self, prepared, expected_code, stream=False):
+        cache_key = None
+        cached = None
+        if self.cache and prepared.method == "GET":
+            cache_key = self.cache.key(prepared, self.creds)
+            cached = self.cache.lookup(cache_key)
+            if cached and self.cache.is_fresh(cached):
+                return self.cache.response(cached, prepared)
+            if cached:
+                prepared.headers.update(cached.validators)
+        response = self.send(prepared, stream)
+        if cached and response.status_code == requests.codes.not_modified:
+            # A streamed 304 only returns its connection to the pool once
+            # closed.
+            response.close()
+            self.cache.refresh(cache_key, cached)
+            return self.cache.response(cached, prepared, response)
+        if cache_key and response.status_code == expected_code:
+            if stream:
+                # Stored as the body is read, see read_body.
+                response.cache_key = cache_key
+            else:
+                self.cache.store(cache_key, response)
+        return response
 
-    def send_request(self, request, expected_code):
-        session = requests.Session()
+    def send_request(self, request, expected_code, not_modified=False,
+                     missing=False, stream=False):
+        # Streamed bodies are left unread when the expected status came
+        # back, the others are read right away.
         self.prepare_creds(request)
-        response = session.send(session.prepare_request(request))
+        prepared = self.session.prepare_request(request)
+        with self.phase("request"):
+            start = perf_counter()
+            response = self.fetch(prepared, expected_code, stream)
+            pending = stream and not response.from_cache \
+                and response.status_code == expected_code
+            if self.observers:
+                record = RequestRecord(
+                    prepared.method, prepared.url, response.status_code, start,
+                    perf_counter() - start, response.elapsed.total_seconds(),
+                    0 if pending else len(response.content), response.retries,
+                    response.from_cache,
+                )
+                if pending:
+                    response.record = record
+                else:
+                    self.notify("on_request", record)
+        if not_modified and response.status_code == requests.codes.not_modified:
+            return response
+        if missing and response.status_code in self.MISSING_CODES:
+            return response
         if response.status_code != expected_code:
-            raise APIException(self.get_error(response))
+            raise APIException(self.get_error(response), response.status_code)
         return response
 
-    def get_page_count(self, request):
-        request.method = "HEAD"
-        response = self.send_request(request, requests.codes.ok)
-        return self.process_page_count(response)
+    def retry_page(self, request, error):
+        # Whether the request was changed to retry a page refused with
+        # error.
+        return False
 
-    def get_page(self, request, page):
+    def send_page(self, request, page):
+        request = copy_request(request)
         request.method = "GET"
         self.prepare_page(request, page)
-        return self.send_request(request, requests.codes.ok).json()
+        return self.send_request(request, requests.codes.ok, stream=True)
+
+    def get_page(self, request, page):
+        try:
+            return self.send_page(request, page)
+        except APIException as e:
+            if not self.retry_page(request, e):
+                raise
+        return self.send_page(request, page)
+
+    def get_next_page(self, request, url):
+        # Next links already carry every query parameter, cursor included.
+        request = copy_request(request)
+        request.method = "GET"
+        request.url = url
+        request.params = {}
+        return self.send_request(request, requests.codes.ok, stream=True)
+
+    def get_pages(self, request, pages):
+        # Keep at most one page per job in flight so that pages are only
+        # fetched a little ahead of what the caller consumes.
+        pages = iter(pages)
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            pending = deque(
+                executor.submit(self.get_page, request, i)
+                for i in islice(pages, self.jobs)
+            )
+            try:
+                while pending:
+                    with self.phase("wait_page"):
+                        response = pending.popleft().result()
+                    for i in islice(pages, 1):
+                        pending.append(executor.submit(self.get_page, request, i))
+                    yield from self.decode_items(response)
+            finally:
+                for page in pending:
+                    if not page.cancel():
+                        page.add_done_callback(close_page)
+
+    def read_body(self, response):
+        # Streamed bodies are teed to the cache as they are read, their
+        # request is only reported once they were read entirely, with the
+        # time spent reading them but not the one spent by the caller.
+        chunks = response.iter_content(STREAM_CHUNK_SIZE)
+        if response.cache_key:
+            chunks = self.cache.tee(response.cache_key, response, chunks)
+        record = response.record
+        try:
+            while True:
+                start = perf_counter()
+                chunk = next(chunks, None)
+                if record:
+                    record.duration += perf_counter() - start
+                if chunk is None:
+                    return
+                if record:
+                    record.size += len(chunk)
+                yield chunk
+        except requests.RequestException as e:
+            raise APIException(e)
+        finally:
+            chunks.close()
+            response.close()
+            if record:
+                self.notify("on_request", record)
+
+    def decode(self, response):
+        with self.phase("decode"):
+            return loads(b"".join(self.read_body(response)))
+
+    def decode_items(self, response):
+        # Pages are decoded one element at a time, only the ones the
+        # caller still holds stay in memory.
+        body = self.read_body(response)
+        with closing(body):
+            yield from self.timed("decode", iter_array(body))
 
     def get_all_pages(self, request):
-        page_count = self.get_page_count(request)
-        elements = []
-        for i in range(1, page_count + 1):
-            elements += self.get_page(request, i)
-        return elements
+        response = self.get_page(request, 1)
+        page_count, next_url = self.process_pagination(response)
+        yield from self.decode_items(response)
+        if page_count:
+            yield from self.get_pages(request, range(2, page_count + 1))
+            return
+        while next_url:
+            response = self.get_next_page(request, next_url)
+            page_count, next_url = self.process_pagination(response)
+            yield from self.decode_items(response)
 
     def get_user(self):
         request = self.request(self.USER_ENDPOINT, "GET")
-        user = self.send_request(request, requests.codes.ok).json()
+        user = self.decode(self.send_request(request, requests.codes.ok))
         return self.filter_user(user)
 
+    def prepare_repos(self, request):
+        pass
+
+    def filter_owned(self, repos):
+        user = self.get_user()
+        return (repo for repo in repos if repo.namespace == user)
+
     def get_repos(self):
         request = self.request(self.REPOS_ENDPOINT)
-        repos = self.get_all_pages(request)
-        return sorted(self.filter_repos(repos), key=lambda x: str(x).lower())
+        self.prepare_repos(request)
+        if self.owned and self.OWNED_PARAMS:
+            request.params.update(self.OWNED_PARAMS)
+        repos = self.timed("get_all_pages", self.get_all_pages(request))
+        repos = self.timed("filter_repos", self.filter_repos(repos))
+        if self.owned and not self.OWNED_PARAMS:
+            repos = self.filter_owned(repos)
+        yield from repos
 
-    def get_events(self):
+    def prepare_events(self, request, since, until):
+        pass
+
+    def limit_events(self, events, since, until=None):
+        # Events are listed from the most recent one. Servers filtering
+        # events by date may do so by day, bounds are applied here too.
+        if until:
+            events = dropwhile(lambda event: event.date > until, events)
+        if since:
+            events = takewhile(lambda event: event.date >= since, events)
+        return events
+
+    def match_event(self, event):
+        if self.ref and not ref_matches(event, self.ref):
+            return False
+        return not self.sha or sha_matches(event, self.sha)
+
+    def fetch_events(self, since=None, until=None):
         request = self.request(self.EVENTS_ENDPOINT)
-        events = self.get_all_pages(request)
-        return self.filter_events(events)
+        self.prepare_events(request, since, until)
+        events = self.timed("get_all_pages", self.get_all_pages(request))
+        return self.timed("filter_events", self.filter_events(events))
+
+    def get_events(self, since=None, until=None):
+        if self.offline:
+            yield from self.archive.query(
+                self.host, str(self.repo), since, self.ref, self.sha, until=until,
+            )
+            return
+        if self.archive:
+            # Date filtered pages would leave holes in the archive.
+            events = self.archive.update(
+                self.host, str(self.repo), self.fetch_events(),
+            )
+        else:
+            events = self.fetch_events(since, until)
+        events = self.limit_events(events, since, until)
+        yield from (event for event in events if self.match_event(event))
+
+    def poll_events(self, etag=None):
+        # Only the first page is needed to follow a repository. Unchanged
+        # events are reported as None, judged from the caller's ETag: a
+        # cached page may hold events another run fetched first.
+        request = self.request(self.EVENTS_ENDPOINT, "GET")
+        self.prepare_page(request, 1)
+        if etag and not self.cache:
+            request.headers["If-None-Match"] = etag
+        response = self.send_request(
+            request, requests.codes.ok, not_modified=True,
+        )
+        interval = None
+        if self.POLL_INTERVAL_HEADER:
+            interval = response.headers.get(self.POLL_INTERVAL_HEADER)
+        interval = int(interval) if interval and interval.isdigit() else None
+        new_etag = response.headers.get("ETag")
+        if response.status_code == requests.codes.not_modified \
+                or (etag and new_etag == etag):
+            return None, etag, interval
+        events = self.filter_events(self.decode(response))
+        return events, new_etag, interval
+
+    def get_erased_commits(self, before, after):
+        raise APIException("Comparing commits is not supported by this API.")
+
+    def find_erased(self, before, after):
+        # One compare per pair of heads, shared by the copies.
+        key = (str(self.repo), before, after)
+        if key not in self.compared:
+            self.compared[key] = self.get_erased_commits(before, after)
+        return self.compared[key]
+
+    def is_force_push(self, event):
+        if not event.before or NULL_SHA in (event.before, event.after):
+            return False
+        return bool(self.find_erased(event.before, event.after))
+
+    def load_erased(self, event):
+        # The erased commits are unknown when the API cannot compare the
+        # heads, or when the old head is gone: only the old head is then
+        # left to restore.
+        if event.erased is not None or not event.before \
+                or NULL_SHA in (event.before, event.after):
+            return
+        try:
+            event.erased = self.find_erased(event.before, event.after)
+        except APIException:
+            event.erased = False
+            return
+        # The compare found the old head.
+        self.reachable.setdefault((str(self.repo), event.before), True)
 
     def create_branch(self, branch, ref):
         request = self.request(self.CREATE_BRANCH_ENDPOINT, "POST")
         self.prepare_create_branch(request, branch, ref)
         self.send_request(request, requests.codes.created)
 
+    def prepare_commit(self, request):
+        pass
+
+    def commit_exists(self, sha):
+        if not self.COMMITS_ENDPOINT:
+            return True
+        endpoint = "/".join([self.COMMITS_ENDPOINT, sha])
+        request = self.request(endpoint, "GET")
+        self.prepare_commit(request)
+        response = self.send_request(request, requests.codes.ok, missing=True)
+        return response.status_code == requests.codes.ok
+
+    def check_shas(self, shas):
+
+        def check(key):
+            repo, sha = key
+            return key, self.for_repo(repo).commit_exists(sha)
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            return dict(executor.map(check, shas))
+
+    def verify_shas(self, shas):
+        # Returns the (repo, sha) pairs still on the server. Answers are
+        # kept for the lifetime of the wrapper and its copies.
+        shas = list(shas)
+        unknown = {key for key in shas if key not in self.reachable}
+        if unknown:
+            self.reachable.update(self.check_shas(unknown))
+        return {key for key in shas if self.reachable[key]}
+
+    def recovery_candidates(self, event):
+        # The old head first, then the erased commits from the newest. The
+        # commits of the push are reachable from its new head, a branch on
+        # them would recover nothing.
+        commits = event.erased or []
+        candidates = [event.before] + [commit.id for commit in commits]
+        return [sha for sha in candidates if sha and sha != NULL_SHA]
+
+    def verify_events(self, events):
+        # Old heads are checked all at once, then the erased commits of the
+        # pushes whose old head is gone. Events with neither left are
+        # unrecoverable.
+        repo = str(self.repo)
+        events = [event for event in events if event.recovery is None]
+        candidates = [self.recovery_candidates(event) for event in events]
+        reachable = self.verify_shas(
+            (repo, shas[0]) for shas in candidates if shas
+        )
+        rest = []
+        for event, shas in zip(events, candidates):
+            if shas and (repo, shas[0]) in reachable:
+                event.recovery = shas[0]
+            else:
+                rest.append((event, shas[1:]))
+        reachable = self.verify_shas(
+            (repo, sha) for _, shas in rest for sha in shas
+        )
+        for event, shas in rest:
+            event.recovery = next(
+                (sha for sha in shas if (repo, sha) in reachable), False,
+            )
+
+    def restore_ref(self, target):
+        try:
+            self.for_repo(target.repo).create_branch(target.branch, target.sha)
+        except APIException as e:
+            return str(e)
+
+    def restore_refs(self, targets):
+        # Yields (target, error) as soon as each branch is created or
+        # refused, error being None on success. Commits that are gone are
+        # reported without trying to create their branch.
+        targets = list(targets)
+        reachable = self.verify_shas(
+            (target.repo, target.sha) for target in targets
+        )
+        for target in targets:
+            if (target.repo, target.sha) not in reachable:
+                yield target, "Commit not found, it may have been garbage collected."
+        yield from self.create_branches(
+            target for target in targets
+            if (target.repo, target.sha) in reachable
+        )
+
+    def create_branches(self, targets):
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            restores = {
+                executor.submit(self.restore_ref, target): target
+                for target in targets
+            }
+            try:
+                for restore in as_completed(restores):
+                    yield restores[restore], restore.result()
+            finally:
+                for restore in restores:
+                    restore.cancel()
+
     def attach_old_ref(self):
-        branch = "tifu-{}".format(self.event.before)
-        self.create_branch(branch, self.event.before)
+        self.load_erased(self.event)
+        if self.event.erased == []:
+            raise APIException("This push did not erase any commit.")
+        self.verify_events([self.event])
+        if not self.event.recovery:
+            raise APIException(
+                "No commit of this push is left, they may have been "
+                "garbage collected."
+            )
+        branch = "tifu-{}".format(self.event.recovery)
+        self.create_branch(branch, self.event.recovery)
         return branch
 
     def print_auth_method(self, i, size, method):
@@ -198,40 +865,98 @@ class AbstractAPIWrapper(ABC):
 
     def print_event(self, i, size, event):
         header = "[{0:>{1}}] Date: {2}".format(i, size, event.date)
+        if event.recovery is False:
+            header += " (unrecoverable)"
         details = "Ref: {}\n".format(event.ref) if event.ref else ""
         details += "Old head: {}\n".format(event.before) if event.before else ""
-        details += "New head: {}\n* Commits:".format(event.after)
-        commits = ("* {}".format(commit) for commit in event.commits)
+        details += "New head: {}\n".format(event.after)
+        if event.recovery and \
+                event.recovery != self.recovery_candidates(event)[0]:
+            details += "Recoverable from: {}\n".format(event.recovery)
+        commits = []
+        if event.erased is None:
+            details += "* Pushed commits:"
+            commits = event.commits
+        elif event.erased is False:
+            details += "* Erased commits: unknown"
+        elif event.erased:
+            details += "* Erased commits:"
+            commits = event.erased
+        else:
+            details += "* Nothing erased"
+        commits = ("* {}".format(commit) for commit in commits)
         print(header)
         print(indent(details, (size + 3) * " "))
         print(indent("\n".join(commits), (size + 7) * " "))
         print()
 
+    @property
+    def ndjson(self):
+        return self.output_format == "ndjson"
+
+    def info(self, message=""):
+        # Messages for humans, kept out of NDJSON output.
+        print(message, file=stderr if self.ndjson else None)
+
+    def emit(self, report):
+        print(dumps(report), flush=True)
+
     def print_success(self):
+        if self.ndjson:
+            self.emit({
+                "repo": str(self.repo), "sha": self.event.recovery,
+                "branch": self.branch, "url": self.REPO_BRANCH_URL,
+            })
+            return
         print("Success! Your restored commits are on branch {}".format(self.branch))
         print(self.REPO_BRANCH_URL)
 
     def print_failure(self, error):
+        if self.ndjson:
+            self.emit({"error": str(error)})
+            return
         print("Oops. Something went wrong :(")
         print("Error: {}".format(error))
 
-    def print_and_select(self, header, empty, print_fcn, elements, fast=False):
-        if not elements:
-            print(empty)
-            return None
-        if fast and len(elements) == 1:
-            return elements[0]
-        print(header)
-        size = int(log10(len(elements))) + 1
-        for i, element in enumerate(elements, start=1):
-            print_fcn(i, size, element)
-        choice = -1
-        while not 0 < choice <= len(elements):
+    def read_choice(self, count, more):
+        prompt = "Choice (empty for more): " if more else "Choice: "
+        while True:
+            choice = input(prompt)
+            if more and not choice:
+                return None
             try:
-                choice = int(input("Choice: "))
+                choice = int(choice)
             except ValueError:
                 continue
-        return elements[choice - 1]
+            if 0 < choice <= count:
+                return choice
+
+    def print_and_select(self, header, empty, print_fcn, elements, fast=False,
+                         prepare_fcn=None):
+        # Elements may be lazily fetched: print them by batches and only
+        # ask for the next ones if the user did not find what they need.
+        elements = iter(elements)
+        shown = list(islice(elements, self.SELECT_BATCH))
+        if not shown:
+            print(empty)
+            return None
+        if fast and len(shown) == 1:
+            return shown[0]
+        print(header)
+        batch = shown
+        while True:
+            if prepare_fcn:
+                prepare_fcn(batch)
+            size = int(log10(len(shown))) + 1
+            start = len(shown) - len(batch) + 1
+            for i, element in enumerate(batch, start=start):
+                print_fcn(i, size, element)
+            more = len(batch) == self.SELECT_BATCH
+            choice = self.read_choice(len(shown), more)
+            if choice:
+                return shown[choice - 1]
+            batch = list(islice(elements, self.SELECT_BATCH))
+            shown += batch
 
     def select_auth_method(self):
         return self.print_and_select(
@@ -240,37 +965,161 @@ class AbstractAPIWrapper(ABC):
         )
 
     def select_repo(self):
-        repos = self.get_repos()
-        return self.print_and_select(
-            self.REPOS_HEADER, self.REPOS_EMPTY, self.print_repo, repos,
-        )
+        with closing(self.get_repos()) as repos:
+            return self.print_and_select(
+                self.REPOS_HEADER, self.REPOS_EMPTY, self.print_repo, repos,
+            )
+
+    def find_events(self, events):
+        with self.phase("index"):
+            index = SearchIndex(events)
+        with self.phase("find"):
+            return index.find(self.find)
 
     def select_event(self):
-        events = self.get_events()
-        return self.print_and_select(
-            self.EVENTS_HEADER, self.EVENTS_EMPTY, self.print_event, events,
-        )
+        with closing(self.get_events(self.since, self.until)) as events:
+            empty = self.EVENTS_EMPTY
+            if self.find:
+                events = self.find_events(events)
+                empty = self.FIND_EMPTY
+            return self.print_and_select(
+                self.EVENTS_HEADER, empty, self.print_event, events,
+                prepare_fcn=self.verify_events if self.verify else None,
+            )
+
+    @property
+    def picking(self):
+        return bool(self.pick or self.pick_ref or self.pick_sha)
+
+    def is_picked(self, event):
+        if self.pick_ref and not ref_matches(event, self.pick_ref):
+            return False
+        return not self.pick_sha or sha_matches(event, self.pick_sha)
+
+    def write_repos(self):
+        with closing(self.get_repos()) as repos:
+            for repo in repos:
+                self.emit({"repo": str(repo)})
+
+    def write_events(self):
+        # Events are written as soon as they are listed, or verified by
+        # batches.
+        with closing(self.get_events(self.since, self.until)) as events:
+            if self.find:
+                events = self.find_events(events)
+            events = iter(events)
+            while True:
+                batch = list(islice(events, self.SELECT_BATCH if self.verify else 1))
+                if not batch:
+                    return
+                if self.verify:
+                    self.verify_events(batch)
+                for event in batch:
+                    self.emit(report_event(event))
+
+    def find_force_push(self, events):
+        # Events are compared by batches of jobs, the most recent one that
+        # erased commits wins.
+        events = iter(events)
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while True:
+                batch = list(islice(events, self.jobs))
+                if not batch:
+                    return None
+                list(executor.map(self.load_erased, batch))
+                event = next((event for event in batch if event.erased), None)
+                if event:
+                    return event
+
+    def pick_event(self):
+        # Only force pushes are picked, shown with their erased commits.
+        with closing(self.get_events(self.since, self.until)) as events:
+            if self.find:
+                events = self.find_events(events)
+            event = self.find_force_push(
+                event for event in events if self.is_picked(event)
+            )
+        if not event:
+            raise APIException(self.PICK_EMPTY)
+        if self.verify:
+            self.verify_events([event])
+        if self.ndjson:
+            self.emit(report_event(event))
+        else:
+            self.print_event(1, 1, event)
+        return event
+
+    def confirm(self):
+        while True:
+            answer = input("Restore it? [y/N] ").strip().lower()
+            if answer in ["", "n", "no"]:
+                return False
+            if answer in ["y", "yes"]:
+                return True
+
+    def restore_event(self):
+        # Returns whether it went through. Without --yes, picked events are
+        # confirmed, or only written in NDJSON.
+        if self.picking:
+            self.event = self.pick_event()
+            if not self.yes:
+                if self.ndjson:
+                    return True
+                if not self.confirm():
+                    return False
+        elif self.ndjson:
+            self.write_events()
+            return True
+        else:
+            self.event = self.select_event()
+            print()
+            if not self.event:
+                return False
+        self.branch = self.attach_old_ref()
+        self.print_success()
+        return True
+
+    def get_env_creds(self):
+        for method, _, _ in self.AUTH_METHODS:
+            names = self.AUTH_ENV.get(method)
+            values = [environ.get(name) for name in names or []]
+            if names and all(values):
+                self.auth_method = method
+                return self.env_creds(method, values)
+        return None
+
+    def env_creds(self, method, values):
+        return values[0] if len(values) == 1 else tuple(values)
 
     def get_creds(self):
+        creds = self.get_env_creds()
+        if creds is not None:
+            return creds
+        if self.ndjson:
+            raise APIException(
+                "Set TIFU_TOKEN, or TIFU_LOGIN and TIFU_PASSWORD, to use "
+                "NDJSON output."
+            )
         self.auth_method, auth_fcn, _ = self.select_auth_method()
         return auth_fcn()
 
     def execute(self):
+        # Returns whether it went through, see restore_event. Without a
+        # repository, NDJSON output lists the repositories.
         try:
             self.creds = self.get_creds()
-            print()
+            self.info()
             user = self.get_user()
-            print("Authenticated as user {}.\n".format(user))
+            self.info("Authenticated as user {}.\n".format(user))
+            if not self.repo and self.ndjson:
+                self.write_repos()
+                return True
             if not self.repo:
                 self.repo = self.select_repo()
                 print()
             if not self.repo:
-                return
-            self.event = self.select_event()
-            print()
-            if not self.event:
-                return
-            self.branch = self.attach_old_ref()
-            self.print_success()
+                return False
+            return self.restore_event()
         except APIException as e:
             self.print_failure(e)
+            return False
@@ -1,8 +1,11 @@
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from getpass import getpass
+from math import ceil
 from urllib.parse import parse_qs, urlparse
 
-from .generics import AbstractAPIWrapper, Commit, PushEvent, Repo
+import requests
+
+from .generics import APIException, AbstractAPIWrapper, Commit, PushEvent, Repo
 
 
 class GithubAPIWrapper(AbstractAPIWrapper):
@@ -10,11 +13,29 @@ class GithubAPIWrapper(AbstractAPIWrapper):
     DEFAULT_HOST = "github.com"
     USER_ENDPOINT = "user"
     REPOS_ENDPOINT = "user/repos"
+    GRAPHQL_ENDPOINT = "graphql"
+    PER_PAGE = 100
+    GRAPHQL_BATCH = 50
+    # Malformed or unknown SHAs get a 422.
+    MISSING_CODES = [404, 422]
+    # Leaves out repositories only visible through an organization.
+    OWNED_PARAMS = {"affiliation": "owner,collaborator"}
+    POLL_INTERVAL_HEADER = "X-Poll-Interval"
+    PROBE_ENDPOINT = "meta"
+    PROBE_HEADER = "X-GitHub-Request-Id"
+    RATELIMIT_HEADERS = (
+        "X-RateLimit-Remaining", "X-RateLimit-Reset", "X-RateLimit-Limit",
+    )
 
     @property
     def API_URL(self):
         return "https://api.{}".format(self.host)
 
+    @property
+    def PROBE_URLS(self):
+        # GitHub Enterprise Server is reached under /api/v3.
+        return [self.API_URL, "https://{}/api/v3/".format(self.host)]
+
     @property
     def REPO_BRANCH_URL(self):
         return "https://{}/{}/tree/{}".format(self.host, self.repo, self.branch)
@@ -27,6 +48,10 @@ class GithubAPIWrapper(AbstractAPIWrapper):
     def CREATE_BRANCH_ENDPOINT(self):
         return "/".join(["repos", str(self.repo), "git", "refs"])
 
+    @property
+    def COMMITS_ENDPOINT(self):
+        return "/".join(["repos", str(self.repo), "git", "commits"])
+
     @property
     def AUTH_METHODS(self):
         return [
@@ -42,16 +67,25 @@ class GithubAPIWrapper(AbstractAPIWrapper):
 
     def prepare_page(self, request, page):
         request.params["page"] = str(page)
+        request.params["per_page"] = str(self.PER_PAGE)
+
+    def prepare_repos(self, request):
+        # Recently pushed repositories first, they are listed as they come.
+        request.params["sort"] = "pushed"
 
     def prepare_create_branch(self, request, branch, ref):
         request.json = {"sha": ref, "ref": "refs/heads/{}".format(branch)}
 
-    def process_page_count(self, response):
+    def process_pagination(self, response):
+        next_url = response.links.get("next", {}).get("url")
         last = response.links.get("last")
         if not last:
-            return 1
+            return None, next_url
         query_string = urlparse(last.get("url")).query
-        return int(parse_qs(query_string).get("page")[-1])
+        page = parse_qs(query_string).get("page")
+        if not page:
+            return None, next_url
+        return int(page[-1]), next_url
 
     def filter_user(self, user):
         return user.get("login")
@@ -63,7 +97,7 @@ class GithubAPIWrapper(AbstractAPIWrapper):
             project = repo.get("name")
             return Repo(namespace, project)
 
-        return [filter_repo(repo) for repo in repos]
+        return (filter_repo(repo) for repo in repos)
 
     def filter_commits(self, commits):
 
@@ -72,7 +106,7 @@ class GithubAPIWrapper(AbstractAPIWrapper):
             author = commit.get("author")
             author_name = author.get("name")
             author_email = author.get("email")
-            message = commit.get("message").split("\n")[0]
+            message = commit.get("message")
             return Commit(id, author_name, author_email, message)
 
         return [filter_commit(commit) for commit in commits]
@@ -84,13 +118,183 @@ class GithubAPIWrapper(AbstractAPIWrapper):
             ref = payload.get("ref")
             before = payload.get("before")
             after = payload.get("head")
-            created_at = event.get("created_at")
-            date = datetime.strptime(created_at, "%Y-%m-%dT%H:%M:%SZ")
+            date = event.get("created_at")
             commits = self.filter_commits(payload.get("commits")[::-1])
-            return PushEvent(ref, before, after, date, commits)
+            id = event.get("id")
+            return PushEvent(ref, before, after, date, commits, id)
 
         events = (event for event in events if event.get("type") == "PushEvent")
-        return [filter_event(event) for event in events]
+        return (filter_event(event) for event in events)
+
+    def compare(self, base, head, page=None):
+        compare = "{}...{}".format(base, head)
+        endpoint = "/".join(["repos", str(self.repo), "compare", compare])
+        request = self.request(endpoint, "GET")
+        if page:
+            request.params = {"page": str(page), "per_page": str(self.PER_PAGE)}
+        return self.send_request(request, requests.codes.ok).json()
+
+    def get_erased_commits(self, before, after):
+        # Commits reachable from the old head but not from the new one. A
+        # compare lists up to 250 of them, the pages of larger ones are
+        # then fetched concurrently.
+        comparison = self.compare(after, before)
+        commits = comparison.get("commits")
+        total = comparison.get("total_commits") or 0
+        if total > len(commits):
+            pages = range(1, ceil(total / self.PER_PAGE) + 1)
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                commits = [
+                    commit
+                    for page in executor.map(
+                        lambda page: self.compare(after, before, page), pages,
+                    )
+                    for commit in page.get("commits")
+                ]
+        commits = (
+            dict(commit.get("commit"), sha=commit.get("sha"))
+            for commit in commits
+        )
+        return self.filter_commits(list(commits)[::-1])
+
+    def graphql(self, query, variables):
+        # Errors of a field are reported along its alias, the other fields
+        # are still resolved.
+        request = self.request(self.GRAPHQL_ENDPOINT, "POST")
+        request.json = {"query": query, "variables": variables}
+        result = self.send_request(request, requests.codes.ok).json()
+        errors = {}
+        for error in result.get("errors") or []:
+            alias = (error.get("path") or [None])[0]
+            errors.setdefault(alias, error.get("message"))
+        if result.get("data") is None:
+            raise APIException(errors.get(None) or "GraphQL request failed.")
+        return result.get("data"), errors
+
+    def get_repository_ids(self, repos):
+        declarations = []
+        fields = []
+        variables = {}
+        for i, repo in enumerate(repos):
+            owner, _, name = repo.partition("/")
+            declarations.append("$o{0}: String!, $n{0}: String!".format(i))
+            fields.append(
+                "r{0}: repository(owner: $o{0}, name: $n{0}) {{ id }}".format(i),
+            )
+            variables["o{}".format(i)] = owner
+            variables["n{}".format(i)] = name
+        query = "query({}) {{ {} }}".format(
+            ", ".join(declarations), " ".join(fields),
+        )
+        data, errors = self.graphql(query, variables)
+        ids = {}
+        for i, repo in enumerate(repos):
+            alias = "r{}".format(i)
+            ids[repo] = (data.get(alias) or {}).get("id"), errors.get(alias)
+        return ids
+
+    def create_refs(self, batch, ids):
+        declarations = []
+        fields = []
+        variables = {}
+        results = {}
+        for i, target in enumerate(batch):
+            id, error = ids[target.repo]
+            if not id:
+                results[i] = error or "Repository not found."
+                continue
+            alias = "t{}".format(i)
+            declarations.append("${}: CreateRefInput!".format(alias))
+            fields.append(
+                "{0}: createRef(input: ${0}) {{ clientMutationId }}".format(alias),
+            )
+            variables[alias] = {
+                "repositoryId": id,
+                "name": "refs/heads/{}".format(target.branch),
+                "oid": target.sha,
+            }
+        if variables:
+            query = "mutation({}) {{ {} }}".format(
+                ", ".join(declarations), " ".join(fields),
+            )
+            data, errors = self.graphql(query, variables)
+            for alias in variables:
+                if alias in errors or data.get(alias) is None:
+                    error = errors.get(alias) or "Unable to create the branch."
+                    results[int(alias[1:])] = error
+        return [(target, results.get(i)) for i, target in enumerate(batch)]
+
+    def restore_batch(self, batch):
+        # Many createRef mutations share a single GraphQL request. Without
+        # GraphQL (e.g. older Enterprise servers), refs are created one by
+        # one through the REST API.
+        try:
+            repos = sorted({target.repo for target in batch})
+            return self.create_refs(batch, self.get_repository_ids(repos))
+        except APIException:
+            return [(target, self.restore_ref(target)) for target in batch]
+
+    def batches(self, elements):
+        elements = list(elements)
+        return [
+            elements[i:i + self.GRAPHQL_BATCH]
+            for i in range(0, len(elements), self.GRAPHQL_BATCH)
+        ]
+
+    def create_branches(self, targets):
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            restores = [
+                executor.submit(self.restore_batch, batch)
+                for batch in self.batches(targets)
+            ]
+            try:
+                for restore in as_completed(restores):
+                    yield from restore.result()
+            finally:
+                for restore in restores:
+                    restore.cancel()
+
+    def check_batch(self, batch):
+        # Up to GRAPHQL_BATCH object lookups in a single request, unknown
+        # repositories being reported as errors.
+        declarations = []
+        fields = []
+        variables = {}
+        for i, (repo, sha) in enumerate(batch):
+            owner, _, name = repo.partition("/")
+            declarations.append(
+                "$o{0}: String!, $n{0}: String!, $s{0}: GitObjectID!".format(i),
+            )
+            fields.append(
+                "c{0}: repository(owner: $o{0}, name: $n{0}) "
+                "{{ object(oid: $s{0}) {{ id }} }}".format(i),
+            )
+            variables["o{}".format(i)] = owner
+            variables["n{}".format(i)] = name
+            variables["s{}".format(i)] = sha
+        query = "query({}) {{ {} }}".format(
+            ", ".join(declarations), " ".join(fields),
+        )
+        try:
+            data, _ = self.graphql(query, variables)
+        except APIException:
+            return super().check_shas(batch)
+        return {
+            key: bool((data.get("c{}".format(i)) or {}).get("object"))
+            for i, key in enumerate(batch)
+        }
+
+    def check_shas(self, shas):
+        reachable = {}
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            for checked in executor.map(self.check_batch, self.batches(shas)):
+                reachable.update(checked)
+        return reachable
+
+    def env_creds(self, method, values):
+        if method == "oauth":
+            return (values[0], "x-oauth-basic")
+        return super().env_creds(method, values)
 
     def auth_basic(self):
         login = input("Login: ")
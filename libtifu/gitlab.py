@@ -1,5 +1,7 @@
-from datetime import datetime
-from urllib.parse import quote_plus
+from datetime import timedelta
+from urllib.parse import parse_qs, quote_plus, urlparse
+
+import requests
 
 from .generics import AbstractAPIWrapper, Commit, PushEvent, Repo
 
@@ -9,10 +11,22 @@ class GitlabAPIWrapper(AbstractAPIWrapper):
     DEFAULT_HOST = "gitlab.com"
     USER_ENDPOINT = "user"
     REPOS_ENDPOINT = "projects"
+    PER_PAGE = 100
+    OWNED_PARAMS = {"membership": "true"}
+    PROBE_ENDPOINT = "version"
+    PROBE_HEADER = "X-Gitlab-Meta"
+    RATELIMIT_HEADERS = (
+        "RateLimit-Remaining", "RateLimit-Reset", "RateLimit-Limit",
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Hosts refusing keyset pagination, shared by the copies.
+        self.offset_only = set()
 
     @property
     def API_URL(self):
-        return "https://{}/api/v3/".format(self.host)
+        return "https://{}/api/v4/".format(self.host)
 
     @property
     def REPO_BRANCH_URL(self):
@@ -28,6 +42,18 @@ class GitlabAPIWrapper(AbstractAPIWrapper):
             "projects", quote_plus(str(self.repo)), "repository", "branches",
         ])
 
+    @property
+    def COMPARE_ENDPOINT(self):
+        return "/".join([
+            "projects", quote_plus(str(self.repo)), "repository", "compare",
+        ])
+
+    @property
+    def COMMITS_ENDPOINT(self):
+        return "/".join([
+            "projects", quote_plus(str(self.repo)), "repository", "commits",
+        ])
+
     @property
     def AUTH_METHODS(self):
         return [
@@ -35,19 +61,76 @@ class GitlabAPIWrapper(AbstractAPIWrapper):
         ]
 
     def get_error(self, response):
-        return response.json().get("message")
+        # Invalid parameters are reported as an error rather than a message.
+        error = response.json()
+        return error.get("message") or error.get("error")
 
     def prepare_creds(self, request):
         request.headers["PRIVATE-TOKEN"] = self.creds
 
+    @property
+    def keyset(self):
+        return self.host not in self.offset_only
+
     def prepare_page(self, request, page):
-        request.params["page"] = str(page)
+        # Keyset pages are only reached through next links.
+        if request.params.get("pagination") != "keyset" or not self.keyset:
+            request.params["page"] = str(page)
+        request.params["per_page"] = str(self.PER_PAGE)
+
+    def prepare_repos(self, request):
+        request.params["simple"] = "true"
+        if self.keyset:
+            # Keyset pagination does not get slower with depth but only
+            # orders projects by id: the most recent ones first.
+            request.params["pagination"] = "keyset"
+            request.params["order_by"] = "id"
+            request.params["sort"] = "desc"
+        else:
+            # Recently active projects first, they are listed as they come.
+            request.params["order_by"] = "last_activity_at"
+
+    def retry_page(self, request, error):
+        # Older instances refuse keyset pagination with a 400: remember it
+        # for their host and fall back to offset pages. Other errors are
+        # left to the caller.
+        if request.params.get("pagination") != "keyset" \
+                or error.status != requests.codes.bad_request \
+                or "pagination" not in str(error):
+            return False
+        self.offset_only.add(self.host)
+        del request.params["pagination"]
+        self.prepare_repos(request)
+        return True
+
+    def prepare_events(self, request, since, until):
+        # Dates are filtered by day, exclusively.
+        request.params["action"] = "pushed"
+        if since:
+            after = since - timedelta(days=1)
+            request.params["after"] = after.strftime("%Y-%m-%d")
+        if until:
+            before = until + timedelta(days=1)
+            request.params["before"] = before.strftime("%Y-%m-%d")
 
     def prepare_create_branch(self, request, branch, ref):
-        request.data = {"ref": ref, "branch_name": branch}
-
-    def process_page_count(self, response):
-        return int(response.headers.get("X-Total-Pages"))
+        request.data = {"ref": ref, "branch": branch}
+
+    def process_pagination(self, response):
+        # X-Total-Pages is omitted on large collections and keyset
+        # pagination only provides a next link. Instances predating keyset
+        # pagination ignore it and answer offset pages: their host then
+        # gets numbered pages.
+        next_url = response.links.get("next", {}).get("url")
+        total_pages = response.headers.get("X-Total-Pages")
+        if self.keyset and (total_pages or "page" in parse_qs(
+                urlparse(next_url or "").query)):
+            query = parse_qs(urlparse(response.request.url).query)
+            if query.get("pagination") == ["keyset"]:
+                self.offset_only.add(self.host)
+        if not total_pages:
+            return None, next_url
+        return int(total_pages), next_url
 
     def filter_user(self, user):
         return user.get("username")
@@ -55,11 +138,11 @@ class GitlabAPIWrapper(AbstractAPIWrapper):
     def filter_repos(self, repos):
 
         def filter_repo(repo):
-            namespace = repo.get("namespace").get("name")
-            project = repo.get("path")
+            # Namespaces may be nested groups.
+            namespace, _, project = repo.get("path_with_namespace").rpartition("/")
             return Repo(namespace, project)
 
-        return [filter_repo(repo) for repo in repos]
+        return (filter_repo(repo) for repo in repos)
 
     def filter_commits(self, commits):
 
@@ -68,25 +151,51 @@ class GitlabAPIWrapper(AbstractAPIWrapper):
             author = commit.get("author")
             author_name = author.get("name")
             author_email = author.get("email")
-            message = commit.get("message").split("\n")[0]
+            message = commit.get("message")
             return Commit(id, author_name, author_email, message)
 
         return [filter_commit(commit) for commit in commits]
 
     def filter_events(self, events):
 
+        # Push events only describe the new head commit.
         def filter_event(event):
-            data = event.get("data")
+            data = event.get("push_data")
             ref = data.get("ref")
-            before = data.get("before")
-            after = data.get("after")
-            created_at = event.get("created_at")
-            date = datetime.strptime(created_at, "%Y-%m-%dT%H:%M:%S.%fZ")
-            commits = self.filter_commits(data.get("commits")[::-1])
-            return PushEvent(ref, before, after, date, commits)
-
-        events = (event for event in events if event.get("action_name") == "pushed to")
-        return [filter_event(event) for event in events]
+            if data.get("ref_type") == "branch":
+                ref = "refs/heads/{}".format(ref)
+            before = data.get("commit_from")
+            after = data.get("commit_to")
+            date = event.get("created_at")
+            commits = []
+            if after:
+                author = event.get("author") or {}
+                commits.append(Commit(
+                    after, author.get("name"), None, data.get("commit_title") or "",
+                ))
+            id = event.get("id")
+            return PushEvent(ref, before, after, date, commits, id)
+
+        events = (event for event in events if event.get("push_data"))
+        return (filter_event(event) for event in events)
+
+    def get_erased_commits(self, before, after):
+        # Commits reachable from the old head but not from the new one.
+        request = self.request(self.COMPARE_ENDPOINT, "GET")
+        request.params = {"from": after, "to": before}
+        commits = self.send_request(request, requests.codes.ok).json().get("commits")
+        commits = (
+            {
+                "id": commit.get("id"),
+                "message": commit.get("message"),
+                "author": {
+                    "name": commit.get("author_name"),
+                    "email": commit.get("author_email"),
+                },
+            }
+            for commit in commits
+        )
+        return self.filter_commits(list(commits)[::-1])
 
     def auth_token(self):
         print('Create a personal access token with "api" scope:')
@@ -0,0 +1,590 @@
+import os
+import struct
+import subprocess
+import zlib
+from datetime import datetime, timezone
+from glob import glob
+from heapq import heappop, heappush
+from mmap import ACCESS_READ, mmap
+
+from .generics import (
+    NULL_SHA, APIException, AbstractAPIWrapper, Commit, PushEvent,
+)
+
+
+OBJ_COMMIT = 1
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+OBJ_TYPES = {b"commit": 1, b"tree": 2, b"blob": 3, b"tag": 4}
+IDX_MAGIC = b"\377tOc"
+# Clock skew tolerated between a commit and its parents.
+DATE_SLOP = 24 * 3600
+MAX_ERASED = 250
+DELTA_CACHE_SIZE = 256
+# Its entries are the stash list, not lost commits.
+IGNORED_REFLOGS = ["refs/stash"]
+
+
+def read_text(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def varint(data, pos):
+    value = shift = 0
+    while True:
+        c = data[pos]
+        pos += 1
+        value |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return value, pos
+
+
+def apply_delta(base, delta):
+    _, pos = varint(delta, 0)
+    _, pos = varint(delta, pos)
+    out = bytearray()
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            # Copy from the base, offset and size bytes are optional.
+            offset = size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            out += base[offset:offset + (size or 0x10000)]
+        else:
+            out += delta[pos:pos + op]
+            pos += op
+    return bytes(out)
+
+
+class CommitHeader():
+
+    __slots__ = ("parents", "timestamp")
+
+    def __init__(self, parents, timestamp):
+        self.parents = parents
+        self.timestamp = timestamp
+
+
+class Pack():
+
+    # Version 2 pack indexes and their packs are memory-mapped, objects
+    # are looked up by bisecting the index and only inflated when read.
+    def __init__(self, idx_path):
+        base = idx_path[:-len(".idx")]
+        # Cruft packs (git gc --cruft) only hold unreachable objects.
+        self.cruft = os.path.exists(base + ".mtimes")
+        with open(idx_path, "rb") as f:
+            self.idx = mmap(f.fileno(), 0, access=ACCESS_READ)
+        if self.idx[:4] != IDX_MAGIC or self.idx[4:8] != b"\0\0\0\2":
+            raise ValueError("unsupported pack index {}".format(idx_path))
+        with open(base + ".pack", "rb") as f:
+            self.pack = mmap(f.fileno(), 0, access=ACCESS_READ)
+        self.fanout = struct.unpack_from(">256I", self.idx, 8)
+        self.count = self.fanout[255]
+        self.shas = 8 + 256 * 4
+        self.offsets = self.shas + 24 * self.count
+        self.large_offsets = self.offsets + 4 * self.count
+
+    def find(self, sha):
+        low = self.fanout[sha[0] - 1] if sha[0] else 0
+        high = self.fanout[sha[0]]
+        while low < high:
+            mid = (low + high) // 2
+            start = self.shas + 20 * mid
+            current = self.idx[start:start + 20]
+            if current < sha:
+                low = mid + 1
+            elif current > sha:
+                high = mid
+            else:
+                return self.offset(mid)
+        return None
+
+    def sha(self, i):
+        start = self.shas + 20 * i
+        return self.idx[start:start + 20].hex()
+
+    def offset(self, i):
+        offset, = struct.unpack_from(">I", self.idx, self.offsets + 4 * i)
+        if offset & 0x80000000:
+            offset, = struct.unpack_from(
+                ">Q", self.idx, self.large_offsets + 8 * (offset & 0x7fffffff),
+            )
+        return offset
+
+    def header(self, offset):
+        # Returns the type, inflated size, delta base (offset or SHA) and
+        # the position of the data of the object at offset.
+        c = self.pack[offset]
+        pos = offset + 1
+        type = (c >> 4) & 7
+        size = c & 15
+        shift = 4
+        while c & 0x80:
+            c = self.pack[pos]
+            pos += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+        base = None
+        if type == OBJ_OFS_DELTA:
+            c = self.pack[pos]
+            pos += 1
+            base = c & 0x7f
+            while c & 0x80:
+                c = self.pack[pos]
+                pos += 1
+                base = ((base + 1) << 7) | (c & 0x7f)
+            base = offset - base
+        elif type == OBJ_REF_DELTA:
+            base = self.pack[pos:pos + 20]
+            pos += 20
+        return type, size, base, pos
+
+    def inflate(self, pos, size):
+        decompressor = zlib.decompressobj()
+        data = b""
+        step = size + 64
+        while not decompressor.eof:
+            chunk = self.pack[pos:pos + step]
+            if not chunk:
+                raise ValueError("truncated pack")
+            data += decompressor.decompress(chunk)
+            pos += step
+        return data
+
+
+class ObjectStore():
+
+    def __init__(self, directories):
+        self.directories = directories
+        self.packs = []
+        for directory in directories:
+            for idx_path in sorted(glob(os.path.join(directory, "pack", "*.idx"))):
+                try:
+                    self.packs.append(Pack(idx_path))
+                except (OSError, ValueError):
+                    continue
+        self.deltas = {}
+        self.headers = {}
+
+    def find(self, sha):
+        key = bytes.fromhex(sha)
+        for pack in self.packs:
+            offset = pack.find(key)
+            if offset is not None:
+                return pack, offset
+        return None
+
+    def loose_path(self, sha):
+        for directory in self.directories:
+            path = os.path.join(directory, sha[:2], sha[2:])
+            if os.path.exists(path):
+                return path
+        return None
+
+    def has(self, sha):
+        return bool(self.find(sha) or self.loose_path(sha))
+
+    def read_loose(self, path, header_only=False):
+        with open(path, "rb") as f:
+            data = f.read()
+        decompressor = zlib.decompressobj()
+        data = decompressor.decompress(data, 32) if header_only \
+            else decompressor.decompress(data)
+        kind, _, data = data.partition(b"\0")
+        return OBJ_TYPES.get(kind.partition(b" ")[0]), data
+
+    def read_packed(self, pack, offset):
+        # Delta chains are followed down to their base, then applied
+        # upwards. Recently used bases are kept since chains share them.
+        chain = []
+        while (pack, offset) not in self.deltas:
+            type, size, base, pos = pack.header(offset)
+            if type not in [OBJ_OFS_DELTA, OBJ_REF_DELTA]:
+                result = type, pack.inflate(pos, size)
+                if chain:
+                    self.cache_delta(pack, offset, result)
+                break
+            chain.append((pack, offset, pos, size))
+            if type == OBJ_OFS_DELTA:
+                offset = base
+                continue
+            found = self.find(base.hex())
+            if not found:
+                raise ValueError("missing delta base {}".format(base.hex()))
+            pack, offset = found
+        else:
+            result = self.deltas[(pack, offset)]
+        for pack, offset, pos, size in reversed(chain):
+            result = result[0], apply_delta(result[1], pack.inflate(pos, size))
+            self.cache_delta(pack, offset, result)
+        return result
+
+    def cache_delta(self, pack, offset, result):
+        if len(self.deltas) >= DELTA_CACHE_SIZE:
+            del self.deltas[next(iter(self.deltas))]
+        self.deltas[(pack, offset)] = result
+
+    def packed_type(self, pack, offset):
+        # Without inflating anything, deltas have the type of their base.
+        while True:
+            type, _, base, _ = pack.header(offset)
+            if type == OBJ_OFS_DELTA:
+                offset = base
+            elif type == OBJ_REF_DELTA:
+                found = self.find(base.hex())
+                if not found:
+                    return None
+                pack, offset = found
+            else:
+                return type
+
+    def read(self, sha):
+        found = self.find(sha)
+        if found:
+            return self.read_packed(*found)
+        path = self.loose_path(sha)
+        if path:
+            return self.read_loose(path)
+        return None, None
+
+    def peel(self, sha):
+        # Annotated tags are followed to the commit they point to.
+        type, data = self.read(sha)
+        while type == OBJ_TAG:
+            sha = data[len(b"object "):data.index(b"\n")].decode()
+            type, data = self.read(sha)
+        return sha if type == OBJ_COMMIT else None
+
+    def commit(self, sha):
+        # Parents and committer date, all the history walks need. Commits
+        # missing from shallow clones are None.
+        if sha not in self.headers:
+            type, data = self.read(sha)
+            header = None
+            if type == OBJ_COMMIT:
+                parents = []
+                timestamp = 0
+                for line in data.partition(b"\n\n")[0].split(b"\n"):
+                    if line.startswith(b"parent "):
+                        parents.append(line[7:].decode())
+                    elif line.startswith(b"committer "):
+                        timestamp = int(line.rpartition(b"> ")[2].split()[0])
+                header = CommitHeader(parents, timestamp)
+            self.headers[sha] = header
+        return self.headers[sha]
+
+    def loose_commits(self):
+        for directory in self.directories:
+            for path in glob(os.path.join(directory, "[0-9a-f][0-9a-f]", "*")):
+                try:
+                    type, _ = self.read_loose(path, True)
+                except (OSError, zlib.error):
+                    continue
+                if type == OBJ_COMMIT:
+                    yield path[-41:-39] + path[-38:]
+
+    def cruft_commits(self):
+        for pack in self.packs:
+            if not pack.cruft:
+                continue
+            for i in range(pack.count):
+                if self.packed_type(pack, pack.offset(i)) == OBJ_COMMIT:
+                    yield pack.sha(i)
+
+
+class Reachability():
+
+    # Commits reachable from the refs, walked lazily from the most recent
+    # ones. Once every commit left to walk is older than a commit (minus
+    # DATE_SLOP), the walk cannot reach it anymore.
+    def __init__(self, store, tips):
+        self.store = store
+        self.seen = set()
+        self.queue = []
+        for sha in tips:
+            self.push(sha)
+
+    def push(self, sha):
+        if sha in self.seen:
+            return
+        self.seen.add(sha)
+        header = self.store.commit(sha)
+        if header:
+            heappush(self.queue, (-header.timestamp, sha))
+
+    def reaches(self, sha, timestamp):
+        while self.queue and -self.queue[0][0] >= timestamp - DATE_SLOP:
+            _, current = heappop(self.queue)
+            for parent in self.store.commit(current).parents:
+                self.push(parent)
+        return sha in self.seen
+
+
+class LocalWrapper(AbstractAPIWrapper):
+
+    # Lost commits of a local clone, from its reflogs, loose objects and
+    # cruft packs, restored as a local branch (and pushed with --push).
+    DEFAULT_HOST = None
+    API_URL = None
+    USER_ENDPOINT = None
+    REPOS_ENDPOINT = None
+    EVENTS_ENDPOINT = None
+    CREATE_BRANCH_ENDPOINT = None
+    AUTH_METHODS = []
+    EVENTS_HEADER = "Select the lost commits to restore:"
+    EVENTS_EMPTY = "No lost commits."
+    FIND_EMPTY = "No lost commits match your search."
+
+    def __init__(self, path, push=None, **kwargs):
+        super().__init__(os.path.abspath(path), None, **kwargs)
+        self.push = push
+        self.git_dir = self.find_git_dir(self.repo)
+        common_dir = read_text(os.path.join(self.git_dir, "commondir"))
+        self.common_dir = os.path.normpath(
+            os.path.join(self.git_dir, common_dir),
+        ) if common_dir else self.git_dir
+        objects = os.path.join(self.common_dir, "objects")
+        alternates = read_text(os.path.join(objects, "info", "alternates"))
+        directories = [objects] + [
+            os.path.normpath(os.path.join(objects, line))
+            for line in (alternates or "").splitlines() if line
+        ]
+        self.store = ObjectStore(directories)
+
+    def find_git_dir(self, path):
+        git_path = os.path.join(path, ".git")
+        if os.path.isfile(git_path):
+            # Worktrees and submodules point to their git directory.
+            git_dir = read_text(git_path).partition("gitdir:")[2].strip()
+            return os.path.normpath(os.path.join(path, git_dir))
+        if os.path.isdir(git_path):
+            return git_path
+        if os.path.isdir(os.path.join(path, "objects")) \
+                and os.path.exists(os.path.join(path, "HEAD")):
+            return path
+        raise APIException("Not a git repository: {}".format(path))
+
+    @property
+    def REPO_BRANCH_URL(self):
+        if self.push:
+            return "{} ({})".format(self.repo, self.push)
+        return self.repo
+
+    def get_error(self, response):
+        pass
+
+    def prepare_creds(self, request):
+        pass
+
+    def prepare_page(self, request, page):
+        pass
+
+    def prepare_create_branch(self, request, branch, ref):
+        pass
+
+    def process_pagination(self, response):
+        pass
+
+    def filter_user(self, user):
+        pass
+
+    def filter_repos(self, repos):
+        pass
+
+    def filter_commits(self, shas):
+
+        def filter_commit(sha):
+            _, data = self.store.read(sha)
+            header, _, message = data.partition(b"\n\n")
+            name = email = None
+            for line in header.split(b"\n"):
+                if line.startswith(b"author "):
+                    person = line[7:].rpartition(b"> ")[0].decode(errors="replace")
+                    name, _, email = person.partition(" <")
+            return Commit(sha, name, email, message.decode(errors="replace"))
+
+        return [filter_commit(sha) for sha in shas]
+
+    def filter_events(self, lost):
+
+        # (ref, old head, new head, timestamp, erased commits) tuples.
+        def filter_event(event):
+            ref, before, after, timestamp, commits = event
+            # Naive UTC, as the dates of the APIs.
+            date = datetime.fromtimestamp(timestamp, timezone.utc)
+            date = date.replace(tzinfo=None)
+            event = PushEvent(ref, before, after, date, self.filter_commits(commits))
+            # Lost commits are what the reflogs are walked for.
+            event.erased = event.commits
+            return event
+
+        return (filter_event(event) for event in lost)
+
+    def read_refs(self):
+        # Loose and packed refs, tags peeled, and the detached HEADs.
+        refs = {}
+        packed = read_text(os.path.join(self.common_dir, "packed-refs")) or ""
+        for line in packed.splitlines():
+            if line.startswith("#") or line.startswith("^"):
+                continue
+            sha, _, name = line.partition(" ")
+            refs[name] = sha
+        refs_dir = os.path.join(self.common_dir, "refs")
+        for directory, _, files in os.walk(refs_dir):
+            for name in files:
+                path = os.path.join(directory, name)
+                sha = read_text(path)
+                if sha and not sha.startswith("ref:"):
+                    name = os.path.relpath(path, self.common_dir)
+                    refs[name.replace(os.sep, "/")] = sha
+        heads = [os.path.join(self.git_dir, "HEAD")]
+        heads += glob(os.path.join(self.common_dir, "worktrees", "*", "HEAD"))
+        for i, path in enumerate(heads):
+            sha = read_text(path)
+            if sha and not sha.startswith("ref:"):
+                refs["HEAD{}".format(i or "")] = sha
+        return refs
+
+    def reflogs(self):
+        logs = os.path.join(self.common_dir, "logs")
+        for directory, _, files in os.walk(os.path.join(logs, "refs")):
+            for name in files:
+                path = os.path.join(directory, name)
+                ref = os.path.relpath(path, logs).replace(os.sep, "/")
+                if ref not in IGNORED_REFLOGS:
+                    yield ref, path
+        yield "HEAD", os.path.join(self.git_dir, "logs", "HEAD")
+
+    def lost_heads(self):
+        # Commits that were heads at some point: old values of reflog
+        # entries, loose commits and the ones of cruft packs. Each one is
+        # kept with its most recent (ref, new head, timestamp).
+        heads = {}
+
+        def add(sha, ref, after, timestamp):
+            if sha not in heads or heads[sha][2] < timestamp:
+                heads[sha] = (ref, after, timestamp)
+
+        for ref, path in self.reflogs():
+            try:
+                with open(path, "rb") as f:
+                    lines = f.readlines()
+            except OSError:
+                continue
+            for line in lines:
+                fields = line.partition(b"\t")[0].split(b" ")
+                old = fields[0].decode()
+                if old != NULL_SHA and len(fields) > 3:
+                    add(old, ref, fields[1].decode(), int(fields[-2]))
+        for sha in list(self.store.loose_commits()) + list(self.store.cruft_commits()):
+            header = self.store.commit(sha)
+            if header and sha not in heads:
+                add(sha, None, NULL_SHA, header.timestamp)
+        return sorted(heads.items(), key=lambda head: -head[1][2])
+
+    def erased_from(self, tip, reachability):
+        # Commits of tip the walk does not reach, from the newest as the
+        # erased commits of the APIs.
+        erased = set()
+        pending = [tip]
+        while pending and len(erased) < MAX_ERASED:
+            sha = pending.pop()
+            header = self.store.commit(sha)
+            if sha in erased or not header \
+                    or reachability.reaches(sha, header.timestamp):
+                continue
+            erased.add(sha)
+            pending += header.parents
+        order = []
+        pending = [(tip, False)]
+        while pending:
+            sha, children_done = pending.pop()
+            if children_done:
+                order.append(sha)
+            elif sha in erased:
+                erased.remove(sha)
+                pending.append((sha, True))
+                pending += [(parent, False) for parent in self.store.commit(sha).parents]
+        return order[::-1]
+
+    def find_lost(self):
+        # Lost heads that no ref reaches, most recent first. Heads erased
+        # along with another one are listed among its commits instead.
+        tips = (self.store.peel(sha) for sha in self.read_refs().values())
+        reachability = Reachability(self.store, [tip for tip in tips if tip])
+        lost = []
+        for sha, (ref, after, timestamp) in self.lost_heads():
+            header = self.store.commit(sha)
+            if header and not reachability.reaches(sha, header.timestamp):
+                commits = self.erased_from(sha, reachability)
+                lost.append((ref, sha, after, timestamp, commits))
+        covered = {
+            commit for _, sha, _, _, commits in lost
+            for commit in commits if commit != sha
+        }
+        return [head for head in lost if head[1] not in covered]
+
+    def fetch_events(self, since=None, until=None):
+        return self.timed("filter_events", self.filter_events(self.find_lost()))
+
+    def get_erased_commits(self, before, after):
+        reachability = Reachability(self.store, [after])
+        return self.filter_commits(self.erased_from(before, reachability))
+
+    def commit_exists(self, sha):
+        return self.store.commit(sha) is not None
+
+    def check_shas(self, shas):
+        # Local reads, the object store is not shared between threads.
+        return {key: self.commit_exists(key[1]) for key in shas}
+
+    def create_branch(self, branch, ref):
+        # Like git branch: a loose ref, written through a lock file.
+        name = "refs/heads/{}".format(branch)
+        if name in self.read_refs():
+            raise APIException("Branch {} already exists.".format(branch))
+        path = os.path.join(self.common_dir, *name.split("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            fd = os.open(path + ".lock", os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+            with os.fdopen(fd, "w") as f:
+                f.write(ref + "\n")
+            os.replace(path + ".lock", path)
+        except OSError as e:
+            raise APIException(e)
+        if self.push:
+            try:
+                result = subprocess.run(
+                    ["git", "push", self.push, "{}:{}".format(ref, name)],
+                    cwd=self.repo, stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE, universal_newlines=True,
+                )
+            except OSError as e:
+                raise APIException(e)
+            if result.returncode:
+                raise APIException(result.stderr.strip())
+
+    def get_creds(self):
+        return None
+
+    def execute(self):
+        try:
+            return self.restore_event()
+        except APIException as e:
+            self.print_failure(e)
+            return False
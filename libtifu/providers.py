@@ -0,0 +1,124 @@
+import json
+import os
+from importlib import import_module
+from time import time
+
+from .defaults import DEFAULT_HOSTS_PATH, DEFAULT_UNDETECTED_TTL
+
+
+ENTRY_POINT_GROUP = "tifu.providers"
+# Imported on first use only, most commands need a single one.
+BUILTIN_PROVIDERS = {
+    "bitbucket": "libtifu.bitbucket:BitbucketAPIWrapper",
+    "github": "libtifu.github:GithubAPIWrapper",
+    "gitlab": "libtifu.gitlab:GitlabAPIWrapper",
+}
+PUBLIC_HOSTS = {
+    "bitbucket.org": "bitbucket",
+    "github.com": "github",
+    "gitlab.com": "gitlab",
+}
+
+providers = {}
+# host -> (API, API URL), as probed by this process.
+detected = {}
+
+
+def entry_points():
+    # Third-party providers register an AbstractAPIWrapper subclass, e.g.
+    # gitea = tifu_gitea:GiteaAPIWrapper. importlib.metadata is slow to
+    # import, it is only needed for names that are not built in.
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return []
+    points = entry_points()
+    if hasattr(points, "select"):
+        return points.select(group=ENTRY_POINT_GROUP)
+    return points.get(ENTRY_POINT_GROUP, [])
+
+
+def provider_names():
+    names = set(BUILTIN_PROVIDERS)
+    names.update(point.name for point in entry_points())
+    return sorted(names, key=lambda name: (name not in BUILTIN_PROVIDERS, name))
+
+
+def load(target):
+    module, _, attr = target.partition(":")
+    return getattr(import_module(module), attr)
+
+
+def get_provider(name):
+    if name not in providers:
+        if name in BUILTIN_PROVIDERS:
+            providers[name] = load(BUILTIN_PROVIDERS[name])
+        else:
+            point = next(
+                (point for point in entry_points() if point.name == name), None,
+            )
+            if not point:
+                raise KeyError(name)
+            providers[name] = point.load()
+    return providers[name]
+
+
+def load_hosts(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_hosts(path, hosts):
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = "{}.tmp".format(path)
+        with open(tmp_path, "w") as f:
+            json.dump(hosts, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+def read_entry(entry, now):
+    # Entries are {"api", "api_url", "date"}, older files only hold the
+    # API. Hosts nothing answered on are kept for a while only.
+    if isinstance(entry, str):
+        return entry, None
+    if not isinstance(entry, dict):
+        return None
+    if not entry.get("api") \
+            and now - (entry.get("date") or 0) > DEFAULT_UNDETECTED_TTL:
+        return None
+    return entry.get("api"), entry.get("api_url")
+
+
+def probe_host(host, **kwargs):
+    for name in provider_names():
+        api_url = get_provider(name)(None, host, retries=0, **kwargs).probe()
+        if api_url:
+            return name, api_url
+    return None, None
+
+
+def detect_api(host, path=DEFAULT_HOSTS_PATH, **kwargs):
+    # Returns the (API, API URL) of host, (None, None) when unknown.
+    # Self-hosted instances are probed once, the answer is kept in path,
+    # even when nothing answered. kwargs are given to the probing
+    # wrappers (timeout, api_url...).
+    if host in PUBLIC_HOSTS:
+        return PUBLIC_HOSTS[host], None
+    if host in detected:
+        return detected[host]
+    now = time()
+    entry = read_entry(load_hosts(path).get(host), now) if path else None
+    if not entry:
+        entry = probe_host(host, **kwargs)
+        if path:
+            save_hosts(path, dict(load_hosts(path), **{host: {
+                "api": entry[0], "api_url": entry[1], "date": now,
+            }}))
+    detected[host] = entry
+    return entry
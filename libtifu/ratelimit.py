@@ -0,0 +1,83 @@
+from hashlib import sha256
+from random import uniform
+from threading import Lock
+from time import sleep, time
+
+
+# Share of the budget that can be spent without pacing requests.
+BURST_RATIO = 0.9
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 60
+
+limiters = {}
+limiters_lock = Lock()
+
+
+def get_limiter(host, creds):
+    # Budgets are granted per user, so wrappers of a same process using
+    # the same credentials share their limiter.
+    key = (host, sha256(repr(creds).encode()).hexdigest())
+    with limiters_lock:
+        if key not in limiters:
+            limiters[key] = RateLimiter()
+        return limiters[key]
+
+
+def backoff(attempt):
+    return uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class RateLimiter():
+
+    def __init__(self):
+        self.lock = Lock()
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self.blocked_until = 0
+        self.next_slot = 0
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            sleep(delay)
+
+    def reserve(self):
+        # Requests go through freely while the budget is comfortable, then
+        # the remaining tokens are spread evenly until the budget resets.
+        # Returns how long to wait before sending the request.
+        with self.lock:
+            now = time()
+            slot = max(now, self.blocked_until)
+            if self.remaining is not None and self.reset:
+                if self.reset <= now:
+                    self.remaining = self.limit
+                elif self.remaining <= 0:
+                    slot = max(slot, self.reset)
+                elif self.remaining < self.limit * (1 - BURST_RATIO):
+                    interval = (self.reset - now) / self.remaining
+                    slot = max(slot, self.next_slot)
+                    self.next_slot = slot + interval
+                if self.remaining:
+                    self.remaining -= 1
+        return slot - now
+
+    def update(self, remaining, reset, limit):
+        try:
+            remaining, reset = int(remaining), int(reset)
+        except (TypeError, ValueError):
+            return
+        with self.lock:
+            self.remaining = remaining
+            self.limit = int(limit) if limit else max(remaining, self.limit or 0)
+            # GitHub and GitLab send an epoch, the IETF draft a delay.
+            self.reset = reset if reset > 10 ** 9 else time() + reset
+
+    def block(self, delay):
+        # Every worker waits, hammering a throttled host makes it worse.
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time() + delay)
+
+    @property
+    def status(self):
+        return self.remaining, self.limit, self.reset
@@ -0,0 +1,35 @@
+import json
+
+from .generics import RestoreTarget
+
+
+def parse_target(line):
+    # Either a line of a scan report or "REPO SHA [BRANCH]". Reports of
+    # events that could not be compared have no new head.
+    if line.startswith("{"):
+        report = json.loads(line)
+        if not report.get("before") or not report.get("after"):
+            return None
+        return RestoreTarget(report["repo"], report["before"], report.get("branch"))
+    fields = line.split()
+    if len(fields) not in (2, 3):
+        raise ValueError("Bad restore target: {}".format(line))
+    return RestoreTarget(*fields)
+
+
+def read_targets(lines):
+    targets = (parse_target(line.strip()) for line in lines if line.strip())
+    return [target for target in targets if target]
+
+
+def write_report(wrapper, targets, output):
+    count = 0
+    for target, error in wrapper.restore_refs(targets):
+        report = {"repo": target.repo, "sha": target.sha, "branch": target.branch}
+        if error:
+            report["error"] = error
+        else:
+            count += 1
+        output.write(json.dumps(report) + "\n")
+        output.flush()
+    return count
@@ -0,0 +1,84 @@
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .generics import DEFAULT_JOBS, APIException
+
+
+class Scanner():
+
+    def __init__(self, wrapper, since=None, restore=False, jobs=DEFAULT_JOBS,
+                 until=None):
+        self.wrapper = wrapper
+        self.since = since
+        self.until = until
+        self.restore = restore
+        self.jobs = jobs
+
+    def get_repos(self, namespace=None):
+        repos = self.wrapper.get_repos()
+        if namespace:
+            repos = (repo for repo in repos if repo.namespace == namespace)
+        return (str(repo) for repo in repos)
+
+    def report_event(self, wrapper, event):
+        report = {
+            "repo": str(wrapper.repo),
+            "ref": event.ref,
+            "before": event.before,
+            "after": event.after,
+            "date": event.date.isoformat(),
+        }
+        if self.restore:
+            wrapper.event = event
+            try:
+                report["branch"] = wrapper.attach_old_ref()
+            except APIException as e:
+                report["error"] = str(e)
+        return report
+
+    def check_event(self, wrapper, event):
+        # Returns the report of a force push, None for other pushes. A
+        # failed compare (old head collected, no common ancestor) is only
+        # reported for its own event, without the new head.
+        try:
+            if not wrapper.is_force_push(event):
+                return None
+        except APIException as e:
+            return {
+                "repo": str(wrapper.repo), "ref": event.ref,
+                "before": event.before, "error": str(e),
+            }
+        return self.report_event(wrapper, event)
+
+    def scan_repo(self, repo):
+        wrapper = self.wrapper.for_repo(repo)
+        reports = []
+        try:
+            for event in wrapper.get_events(self.since, self.until):
+                report = self.check_event(wrapper, event)
+                if report:
+                    reports.append(report)
+        except APIException as e:
+            reports.append({"repo": repo, "error": str(e)})
+        return reports
+
+    def scan(self, repos):
+        # Reports are yielded as soon as a repository is done, in no
+        # particular order.
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            scans = [executor.submit(self.scan_repo, repo) for repo in repos]
+            try:
+                for scan in as_completed(scans):
+                    yield from scan.result()
+            finally:
+                for scan in scans:
+                    scan.cancel()
+
+    def write_report(self, repos, output):
+        count = 0
+        for report in self.scan(repos):
+            output.write(json.dumps(report) + "\n")
+            output.flush()
+            if "after" in report:
+                count += 1
+        return count
@@ -0,0 +1,78 @@
+from bisect import bisect_left
+from re import compile
+
+
+WORD = compile(r"\w+")
+SHA = compile(r"^[0-9a-f]{4,40}$")
+
+
+def tokenize(text):
+    return WORD.findall(text.lower()) if text else []
+
+
+def prefixed(keys, prefix):
+    # Keys starting with prefix in a sorted list.
+    i = bisect_left(keys, prefix)
+    while i < len(keys) and keys[i].startswith(prefix):
+        yield keys[i]
+        i += 1
+
+
+class SearchIndex():
+
+    # SHAs and words map to the positions of the events containing them.
+    # Sorted views of both are only rebuilt when searching after new
+    # events were added, prefix lookups then bisect them.
+    def __init__(self, events=()):
+        self.events = []
+        self.shas = {}
+        self.words = {}
+        self.sorted_shas = None
+        self.sorted_words = None
+        for event in events:
+            self.add(event)
+
+    def add(self, event):
+        position = len(self.events)
+        self.events.append(event)
+        for sha in [event.before, event.after]:
+            if sha:
+                self.shas.setdefault(sha, set()).add(position)
+        for commit in event.commits:
+            self.shas.setdefault(commit.id, set()).add(position)
+            tokens = tokenize(commit.raw_message)
+            tokens += tokenize(commit.author_name)
+            tokens += tokenize(commit.author_email)
+            for token in set(tokens):
+                self.words.setdefault(token, set()).add(position)
+        self.sorted_shas = None
+        self.sorted_words = None
+
+    def find_sha(self, prefix):
+        if self.sorted_shas is None:
+            self.sorted_shas = sorted(self.shas)
+        positions = set()
+        for sha in prefixed(self.sorted_shas, prefix):
+            positions |= self.shas[sha]
+        return positions
+
+    def find_text(self, text):
+        # Every word must match, the last one may be incomplete.
+        tokens = tokenize(text)
+        if not tokens:
+            return set()
+        if self.sorted_words is None:
+            self.sorted_words = sorted(self.words)
+        last = set()
+        for word in prefixed(self.sorted_words, tokens[-1]):
+            last |= self.words[word]
+        matches = [self.words.get(token, set()) for token in tokens[:-1]]
+        return set.intersection(last, *matches)
+
+    def find(self, query):
+        # Events are returned in the order they were added.
+        query = query.strip().lower()
+        positions = self.find_sha(query) if SHA.match(query) else set()
+        if not positions:
+            positions = self.find_text(query)
+        return [self.events[position] for position in sorted(positions)]
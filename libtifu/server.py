@@ -0,0 +1,296 @@
+import json
+from collections import deque
+from hmac import compare_digest
+from ipaddress import ip_address
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from itertools import islice
+from re import fullmatch, match
+from socket import IPPROTO_TCP, TCP_NODELAY
+from threading import Lock, Thread
+from time import monotonic
+from urllib.parse import parse_qs, unquote, urlparse
+
+from .defaults import (
+    DEFAULT_COMMITS_TTL, DEFAULT_EVENTS_TTL, DEFAULT_PORT, DEFAULT_WORKERS,
+)
+from .generics import APIException, RestoreTarget, parse_date, report_event
+
+
+MAX_EVENTS = 100
+# Bursts of connections wait here rather than being refused and retried
+# by the clients a second later.
+LISTEN_BACKLOG = 1024
+
+
+class RequestException(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def encode(payload):
+    return json.dumps(payload).encode()
+
+
+def get_param(query, name):
+    values = query.get(name)
+    return values[-1] if values else None
+
+
+def is_loopback(host):
+    try:
+        return ip_address(host).is_loopback
+    except ValueError:
+        return host == "localhost"
+
+
+def check_repo(repo):
+    # The repository and commits end up in API paths, where dot segments
+    # would reach other endpoints with the service's credentials.
+    segments = repo.split("/")
+    if len(segments) < 2 or any(
+            segment in (".", "..") or not fullmatch(r"[\w.-]+", segment)
+            for segment in segments):
+        raise RequestException(400, "Invalid repository: {}".format(repo))
+    return repo
+
+
+def check_sha(sha):
+    if not isinstance(sha, str) or not fullmatch(r"[0-9a-fA-F]{4,40}", sha):
+        raise RequestException(400, "Invalid commit: {}".format(sha))
+    return sha
+
+
+def parse_bound(value):
+    # Same dates as the APIs, or days (2017-01-31).
+    if not value:
+        return None
+    try:
+        return parse_date(value if "T" in value else value + "T00:00:00")
+    except ValueError:
+        raise RequestException(400, "Invalid date: {}".format(value))
+
+
+class SingleFlight():
+
+    # Concurrent calls with the same key wait for the first one and share
+    # its result, which is kept ttl seconds once done. Errors are not.
+    def __init__(self, ttl=0):
+        self.ttl = ttl
+        self.lock = Lock()
+        self.calls = {}
+        # (expiry, key, call) by expiry, the ttl being the same for all.
+        self.expiries = deque()
+
+    def expire(self, now):
+        while self.expiries and self.expiries[0][0] <= now:
+            _, key, call = self.expiries.popleft()
+            if self.calls.get(key) is call:
+                del self.calls[key]
+
+    def do(self, key, fcn):
+        with self.lock:
+            self.expire(monotonic())
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+        if leader:
+            try:
+                call.set_result(fcn())
+            except BaseException as e:
+                call.set_exception(e)
+            with self.lock:
+                if self.ttl and not call.exception():
+                    self.expiries.append((monotonic() + self.ttl, key, call))
+                else:
+                    del self.calls[key]
+        return call.result()
+
+
+class RecoveryService():
+
+    # Every request goes through copies of the same wrapper: they share its
+    # connection pool, response cache, rate limiter and known commits.
+    # Known commits and compares are dropped every commits_ttl seconds,
+    # copies in use keep the ones they started with.
+    def __init__(self, wrapper, events_ttl=DEFAULT_EVENTS_TTL,
+                 commits_ttl=DEFAULT_COMMITS_TTL):
+        self.wrapper = wrapper
+        self.flights = SingleFlight(events_ttl)
+        self.commits_ttl = commits_ttl
+        self.lock = Lock()
+        self.expiry = monotonic() + commits_ttl
+
+    def for_repo(self, repo):
+        with self.lock:
+            if monotonic() >= self.expiry:
+                self.wrapper.reachable = {}
+                self.wrapper.compared = {}
+                self.expiry = monotonic() + self.commits_ttl
+            return self.wrapper.for_repo(repo)
+
+    def list_events(self, repo, query, body):
+        limit = get_param(query, "limit") or str(MAX_EVENTS)
+        if not limit.isdigit():
+            raise RequestException(400, "Invalid limit: {}".format(limit))
+        key = (
+            repo, parse_bound(get_param(query, "since")),
+            parse_bound(get_param(query, "until")), get_param(query, "ref"),
+            get_param(query, "sha"), get_param(query, "verify") == "1",
+            min(int(limit), MAX_EVENTS),
+        )
+        # Responses are encoded once for every request waiting on them.
+        return 200, self.flights.do(key, lambda: self.fetch_events(*key))
+
+    def fetch_events(self, repo, since, until, ref, sha, verify, limit):
+        wrapper = self.for_repo(repo)
+        wrapper.ref = ref
+        wrapper.sha = sha
+        with closing(wrapper.get_events(since, until)) as events:
+            events = list(islice(events, limit))
+        if verify:
+            wrapper.verify_events(events)
+        return encode({"events": [report_event(event) for event in events]})
+
+    def verify(self, repo, query, body):
+        shas = query.get("sha")
+        if not shas:
+            raise RequestException(400, "Please specify the commits to verify.")
+        for sha in shas:
+            check_sha(sha)
+        reachable = self.for_repo(repo).verify_shas((repo, sha) for sha in shas)
+        return 200, encode({sha: (repo, sha) in reachable for sha in shas})
+
+    def restore(self, repo, query, body):
+        if not isinstance(body, dict) or not body.get("sha"):
+            raise RequestException(400, "Please specify the commit to restore.")
+        target = RestoreTarget(repo, check_sha(body["sha"]), body.get("branch"))
+        report = {"repo": repo, "sha": target.sha, "branch": target.branch}
+        wrapper = self.for_repo(repo)
+        if not wrapper.verify_shas([(repo, target.sha)]):
+            report["error"] = "Commit not found, it may have been garbage collected."
+            return 404, encode(report)
+        error = wrapper.restore_ref(target)
+        if error:
+            report["error"] = error
+            return 502, encode(report)
+        return 201, encode(report)
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+
+    # Namespaces may be nested (Gitlab groups).
+    ROUTES = [
+        ("GET", r"^/repos/(.+)/events$", "list_events"),
+        ("GET", r"^/repos/(.+)/verify$", "verify"),
+        ("POST", r"^/repos/(.+)/restore$", "restore"),
+    ]
+
+    def setup(self):
+        # Headers and body are written separately, do not let Nagle's
+        # algorithm add delayed ACK latency to every response.
+        super().setup()
+        self.request.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def authorize(self):
+        # With a secret, every request must carry it as a bearer token.
+        secret = self.server.secret
+        if not secret:
+            return
+        expected = "Bearer {}".format(secret).encode()
+        authorization = (self.headers.get("Authorization") or "").encode()
+        if not compare_digest(authorization, expected):
+            raise RequestException(401, "Unauthorized.")
+
+    def read_body(self):
+        length = self.headers.get("Content-Length") or "0"
+        if not length.isdigit():
+            raise RequestException(400, "Invalid Content-Length.")
+        length = int(length)
+        try:
+            return json.loads(self.rfile.read(length)) if length else None
+        except ValueError:
+            raise RequestException(400, "Invalid JSON body.")
+
+    def route(self, method, url):
+        for route_method, pattern, action in self.ROUTES:
+            route = match(pattern, url.path)
+            if route and route_method == method:
+                repo = check_repo(unquote(route.group(1)))
+                return getattr(self.server.service, action), repo
+        raise RequestException(404, "Not found.")
+
+    def handle_request(self, method):
+        url = urlparse(self.path)
+        try:
+            self.authorize()
+            action, repo = self.route(method, url)
+            status, content = action(repo, parse_qs(url.query), self.read_body())
+        except RequestException as e:
+            status, content = e.status, encode({"error": str(e)})
+        except APIException as e:
+            status, content = 502, encode({"error": str(e)})
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+
+class RecoveryServer(HTTPServer):
+
+    request_queue_size = LISTEN_BACKLOG
+
+    # Connections are handled by a bounded pool of workers rather than a
+    # thread each, the others are queued until a worker is free.
+    def __init__(self, wrapper, address=("127.0.0.1", DEFAULT_PORT),
+                 workers=DEFAULT_WORKERS, events_ttl=DEFAULT_EVENTS_TTL,
+                 quiet=False, commits_ttl=DEFAULT_COMMITS_TTL, secret=None):
+        super().__init__(address, ServiceHandler)
+        self.service = RecoveryService(wrapper, events_ttl, commits_ttl)
+        self.quiet = quiet
+        self.secret = secret
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    @property
+    def url(self):
+        return "http://{}:{}/".format(*self.server_address[:2])
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_worker, request, client_address)
+
+    def process_request_worker(self, request, client_address):
+        # As socketserver.ThreadingMixIn.process_request_thread.
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+    def start(self):
+        thread = Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
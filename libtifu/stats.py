@@ -0,0 +1,172 @@
+import json
+import sys
+from threading import Lock, get_ident
+from time import perf_counter
+from urllib.parse import urlparse
+
+
+class RequestRecord():
+
+    __slots__ = (
+        "method", "url", "status", "start", "duration", "elapsed", "size",
+        "retries", "cached", "thread",
+    )
+
+    def __init__(self, method, url, status, start, duration, elapsed, size,
+                 retries, cached):
+        self.method = method
+        self.url = url
+        self.status = status
+        self.start = start
+        self.duration = duration
+        self.elapsed = elapsed
+        self.size = size
+        self.retries = retries
+        self.cached = cached
+        self.thread = get_ident()
+
+    @property
+    def endpoint(self):
+        return urlparse(self.url).path
+
+
+class PhaseRecord():
+
+    __slots__ = ("name", "start", "duration", "exclusive", "thread")
+
+    def __init__(self, name, start, duration, exclusive):
+        self.name = name
+        self.start = start
+        self.duration = duration
+        self.exclusive = exclusive
+        self.thread = get_ident()
+
+
+class Observer():
+
+    def on_request(self, record):
+        pass
+
+    def on_phase(self, record):
+        pass
+
+    def close(self):
+        pass
+
+
+class StatsObserver(Observer):
+
+    def __init__(self, output=sys.stderr):
+        self.output = output
+        self.lock = Lock()
+        self.requests = {}
+        self.phases = {}
+        self.start = perf_counter()
+
+    def on_request(self, record):
+        key = (record.method, record.endpoint)
+        with self.lock:
+            stats = self.requests.setdefault(key, [0, 0, 0, 0, 0, 0])
+            stats[0] += 1
+            stats[1] += record.duration
+            stats[2] += record.elapsed
+            stats[3] += record.size
+            stats[4] += record.retries
+            stats[5] += record.cached
+
+    def on_phase(self, record):
+        with self.lock:
+            stats = self.phases.setdefault(record.name, [0, 0, 0])
+            stats[0] += 1
+            stats[1] += record.duration
+            stats[2] += record.exclusive
+
+    def print_table(self, header, rows):
+        widths = [
+            max(len(str(row[i])) for row in [header] + rows)
+            for i in range(len(header))
+        ]
+        for row in [header] + rows:
+            cells = [
+                str(cell).ljust(width) if i == 0 else str(cell).rjust(width)
+                for i, (cell, width) in enumerate(zip(row, widths))
+            ]
+            print("  ".join(cells), file=self.output)
+
+    def close(self):
+        total = perf_counter() - self.start
+        requests = sorted(self.requests.items(), key=lambda x: -x[1][1])
+        rows = [
+            [
+                "{} {}".format(*key), count, "{:.3f}".format(duration),
+                "{:.3f}".format(elapsed), "{:.1f}".format(size / 1024),
+                retries, cached,
+            ]
+            for key, (count, duration, elapsed, size, retries, cached) in requests
+        ]
+        count = sum(stats[0] for stats in self.requests.values())
+        size = sum(stats[3] for stats in self.requests.values())
+        print("", file=self.output)
+        print("{} request(s), {:.1f} KiB in {:.3f}s".format(
+            count, size / 1024, total,
+        ), file=self.output)
+        if rows:
+            self.print_table(
+                ["request", "count", "time", "headers", "KiB", "retries", "cached"],
+                rows,
+            )
+        phases = sorted(self.phases.items(), key=lambda x: -x[1][2])
+        rows = [
+            [name, count, "{:.3f}".format(duration), "{:.3f}".format(exclusive)]
+            for name, (count, duration, exclusive) in phases
+        ]
+        if rows:
+            print("", file=self.output)
+            self.print_table(["phase", "count", "total", "self"], rows)
+
+
+class TraceObserver(Observer):
+
+    # Chrome trace event format, see chrome://tracing or ui.perfetto.dev.
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.events = []
+        self.start = perf_counter()
+
+    def add_event(self, name, category, start, duration, thread, args=None):
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": int((start - self.start) * 10 ** 6),
+            "dur": int(duration * 10 ** 6),
+            "pid": 1,
+            "tid": thread,
+        }
+        if args:
+            event["args"] = args
+        with self.lock:
+            self.events.append(event)
+
+    def on_request(self, record):
+        self.add_event(
+            "{} {}".format(record.method, record.endpoint), "request",
+            record.start, record.duration, record.thread, {
+                "url": record.url,
+                "status": record.status,
+                "bytes": record.size,
+                "headers": record.elapsed,
+                "retries": record.retries,
+                "cached": record.cached,
+            },
+        )
+
+    def on_phase(self, record):
+        self.add_event(
+            record.name, "phase", record.start, record.duration, record.thread,
+        )
+
+    def close(self):
+        with open(self.path, "w") as f:
+            json.dump({"traceEvents": self.events}, f)
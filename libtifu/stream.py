@@ -0,0 +1,76 @@
+from codecs import getincrementaldecoder
+from json import JSONDecodeError, JSONDecoder
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
+WHITESPACE = " \t\n\r"
+
+decoder = JSONDecoder()
+
+
+def skip_whitespace(text, position):
+    while position < len(text) and text[position] in WHITESPACE:
+        position += 1
+    return position
+
+
+class ArrayDecoder():
+
+    # Elements of a JSON array are decoded as soon as they are complete,
+    # only the current one is buffered. A value ending with the buffer may
+    # be a truncated number or literal, it waits for the next chunk.
+    def __init__(self):
+        self.text_decoder = getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.expected = "["
+
+    def feed(self, chunk, final=False):
+        buffer = self.buffer + self.text_decoder.decode(chunk, final)
+        position = 0
+        elements = []
+        while True:
+            position = skip_whitespace(buffer, position)
+            if position == len(buffer):
+                break
+            if self.expected == "end":
+                raise JSONDecodeError("Extra data", buffer, position)
+            if self.expected == "[":
+                if buffer[position] != "[":
+                    raise JSONDecodeError("Expecting '['", buffer, position)
+                position += 1
+                self.expected = "value"
+            elif self.expected == "separator" or (
+                    self.expected == "value" and buffer[position] == "]"):
+                if buffer[position] == "]":
+                    # The body is still read to its end, complete bodies
+                    # are the only ones cached.
+                    position += 1
+                    self.expected = "end"
+                    continue
+                if buffer[position] != ",":
+                    raise JSONDecodeError("Expecting ','", buffer, position)
+                position += 1
+                self.expected = "element"
+            else:
+                try:
+                    element, end = decoder.raw_decode(buffer, position)
+                except JSONDecodeError:
+                    if final:
+                        raise
+                    break
+                if end == len(buffer) and not final:
+                    break
+                position = end
+                self.expected = "separator"
+                elements.append(element)
+        self.buffer = buffer[position:]
+        if final and self.expected != "end":
+            raise JSONDecodeError("Unterminated array", buffer, position)
+        return elements
+
+
+def iter_array(chunks):
+    array = ArrayDecoder()
+    for chunk in chunks:
+        yield from array.feed(chunk)
+    yield from array.feed(b"", True)
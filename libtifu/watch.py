@@ -0,0 +1,140 @@
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from heapq import heappop, heappush
+from threading import Lock
+from time import sleep, time
+
+from .defaults import DEFAULT_INTERVAL
+from .generics import DEFAULT_JOBS, APIException, event_marker
+from .scan import Scanner
+
+
+SAVE_INTERVAL = 10
+
+
+class RepoState():
+
+    __slots__ = ("repo", "last_event", "etag", "next_poll")
+
+    def __init__(self, repo, last_event=None, etag=None):
+        self.repo = repo
+        self.last_event = last_event
+        self.etag = etag
+        self.next_poll = 0
+
+
+class Watcher():
+
+    def __init__(self, wrapper, repos, interval=DEFAULT_INTERVAL,
+                 jobs=DEFAULT_JOBS, since=None, state_path=None):
+        self.wrapper = wrapper
+        self.interval = interval
+        self.jobs = jobs
+        self.since = since
+        self.state_path = state_path
+        self.lock = Lock()
+        self.scanner = Scanner(wrapper, restore=True)
+        saved = self.load_state()
+        self.states = [
+            RepoState(repo, *saved.get(repo, (None, None))) for repo in repos
+        ]
+
+    def load_state(self):
+        if not self.state_path:
+            return {}
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_state(self):
+        if not self.state_path:
+            return
+        with self.lock:
+            state = {
+                state.repo: (state.last_event, state.etag)
+                for state in self.states
+            }
+            tmp_path = "{}.tmp".format(self.state_path)
+            with open(tmp_path, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.state_path)
+
+    def new_events(self, state, events):
+        # Events come from the most recent one, stop at the last one seen.
+        # Without history, only events after --since are looked at.
+        for event in events:
+            if event_marker(event) == state.last_event:
+                return
+            if state.last_event is None and (
+                    not self.since or event.date < self.since):
+                return
+            yield event
+
+    def poll(self, state):
+        # New events are handled from the oldest, the marker following
+        # each one, and the ETag only moves once all of them were: an
+        # interrupted poll resumes after the last event handled. Known
+        # commits and compares are kept for this poll only.
+        wrapper = self.wrapper.for_repo(state.repo)
+        wrapper.reachable = {}
+        wrapper.compared = {}
+        reports = []
+        interval = self.interval
+        try:
+            events, etag, poll_interval = wrapper.poll_events(state.etag)
+            interval = max(interval, poll_interval or 0)
+            if events is not None:
+                events = list(events)
+                for event in reversed(list(self.new_events(state, events))):
+                    report = self.scanner.check_event(wrapper, event)
+                    if report:
+                        reports.append(report)
+                    state.last_event = event_marker(event)
+                if events:
+                    state.last_event = event_marker(events[0])
+            state.etag = etag
+        except APIException as e:
+            reports.append({"repo": state.repo, "error": str(e)})
+        state.next_poll = time() + interval
+        return reports
+
+    def run(self, output, once=False):
+        # Repositories are polled by at most `jobs` workers, each one as
+        # soon as its poll interval elapsed.
+        queue = [(0, i) for i in range(len(self.states))]
+        running = {}
+        saved = time()
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            try:
+                self.schedule(executor, queue, running, output, once, saved)
+            finally:
+                for poll in running:
+                    poll.cancel()
+                self.save_state()
+
+    def schedule(self, executor, queue, running, output, once, saved):
+        while queue or running:
+            now = time()
+            while queue and queue[0][0] <= now and len(running) < self.jobs:
+                _, i = heappop(queue)
+                running[executor.submit(self.poll, self.states[i])] = i
+            if not running:
+                sleep(max(queue[0][0] - now, 0))
+                continue
+            timeout = None
+            if queue and len(running) < self.jobs:
+                timeout = max(queue[0][0] - now, 0)
+            done, _ = wait(running, timeout, FIRST_COMPLETED)
+            for poll in done:
+                i = running.pop(poll)
+                for report in poll.result():
+                    output.write(json.dumps(report) + "\n")
+                    output.flush()
+                if not once:
+                    heappush(queue, (self.states[i].next_poll, i))
+            if done and time() - saved > SAVE_INTERVAL:
+                self.save_state()
+                saved = time()
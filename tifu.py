@@ -1,39 +1,350 @@
 #! /usr/bin/env python3
 
-from argparse import ArgumentParser
+import os
+import sys
+from argparse import ArgumentParser, ArgumentTypeError, FileType
+from datetime import datetime, timedelta, timezone
 from re import match
 
-from libtifu.bitbucket import BitbucketAPIWrapper
-from libtifu.github import GithubAPIWrapper
-from libtifu.gitlab import GitlabAPIWrapper
-
-
-SERVICES = {
-        "bitbucket": BitbucketAPIWrapper,
-        "github": GithubAPIWrapper,
-        "gitlab": GitlabAPIWrapper,
-}
+# The other libtifu modules are imported by the commands using them: most
+# of them import requests, which takes longer than starting Python.
+from libtifu.defaults import (
+    DEFAULT_ARCHIVE_PATH, DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE,
+    DEFAULT_CACHE_TTL, DEFAULT_COMMITS_TTL, DEFAULT_EVENTS_TTL,
+    DEFAULT_INTERVAL, DEFAULT_JOBS, DEFAULT_POOL_SIZE, DEFAULT_PORT,
+    DEFAULT_RETRIES, DEFAULT_TIMEOUT, DEFAULT_WORKERS,
+)
+from libtifu.providers import (
+    BUILTIN_PROVIDERS, PUBLIC_HOSTS, detect_api, get_provider,
+)
 
 
 class ArgumentException(Exception):
     pass
 
 
-def main():
-    APIS = ["github", "gitlab", "bitbucket"]
+def date(value):
+    # Either an age (12h, 7d) or a UTC date (2017-01-31[T12:00:00]).
+    age = match(r"^(\d+)([hd])$", value)
+    if age:
+        unit = "hours" if age.group(2) == "h" else "days"
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return now - timedelta(**{unit: int(age.group(1))})
+    for date_format in ("%Y-%m-%d", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+    raise ArgumentTypeError("invalid date: {}".format(value))
 
-    parser = ArgumentParser()
-    parser.add_argument("remote", nargs="?", help="git remote")
+
+def add_api_arguments(parser):
+    # Third-party providers are only looked up when named.
     parser.add_argument(
-            "-a", "--api", choices=APIS, metavar="",
-            help="API to use ({})".format(", ".join(APIS)),
+            "-a", "--api", metavar="",
+            help="API to use ({} or an installed provider)".format(
+                ", ".join(sorted(BUILTIN_PROVIDERS)),
+            ),
     )
     parser.add_argument("--host", help="server hostname")
+    parser.add_argument(
+            "--api-url", metavar="URL",
+            help="API base URL (default: derived from the hostname)",
+    )
+    parser.add_argument(
+            "--pool-size", type=int, default=DEFAULT_POOL_SIZE, metavar="N",
+            help="HTTP connection pool size (default: %(default)s)",
+    )
+    parser.add_argument(
+            "--timeout", type=float, default=DEFAULT_TIMEOUT, metavar="SEC",
+            help="HTTP request timeout in seconds (default: %(default)s)",
+    )
+    parser.add_argument(
+            "--retries", type=int, default=DEFAULT_RETRIES, metavar="N",
+            help="retries on connection errors and 5xx (default: %(default)s)",
+    )
+    parser.add_argument(
+            "--no-cache", action="store_true",
+            help="do not use the on-disk HTTP response cache",
+    )
+    parser.add_argument(
+            "--cache-dir", default=DEFAULT_CACHE_DIR, metavar="DIR",
+            help="response cache directory (default: %(default)s)",
+    )
+    parser.add_argument(
+            "--cache-ttl", type=float, default=DEFAULT_CACHE_TTL, metavar="SEC",
+            help="serve cached responses without revalidation for SEC "
+                 "seconds (default: %(default)s)",
+    )
+    parser.add_argument(
+            "--cache-size", type=int, default=DEFAULT_CACHE_SIZE // 2 ** 20,
+            metavar="MB", help="maximum cache size (default: %(default)s)",
+    )
+    parser.add_argument(
+            "--stats", action="store_true",
+            help="print request and timing statistics on exit",
+    )
+    parser.add_argument(
+            "--trace", metavar="FILE",
+            help="write a Chrome trace of requests and phases to FILE",
+    )
+
+
+def add_archive_arguments(parser):
+    parser.add_argument(
+            "--archive", nargs="?", const=DEFAULT_ARCHIVE_PATH, metavar="FILE",
+            help="keep push events in a local archive, fetching only new "
+                 "ones (default: {})".format(DEFAULT_ARCHIVE_PATH),
+    )
+
+
+def open_archive(args):
+    if not args.archive:
+        return None
+    from libtifu.archive import EventArchive
+    return EventArchive(args.archive)
+
+
+def add_repos_arguments(parser, action):
+    parser.add_argument(
+            "repos", nargs="*", metavar="REPO",
+            help="repository name (namespace/project)",
+    )
+    parser.add_argument(
+            "-f", "--repos-file", type=FileType("r"), metavar="FILE",
+            help="file listing one repository per line (- for stdin)",
+    )
+    parser.add_argument(
+            "-n", "--namespace", metavar="NAMESPACE",
+            help="{} the accessible repositories of NAMESPACE".format(action),
+    )
+    parser.add_argument(
+            "--all", action="store_true",
+            help="{} every accessible repository".format(action),
+    )
+
+
+def check_repos_arguments(args, action):
+    if not args.api and not args.host:
+        raise ArgumentException("Please specify at least an API or a host.")
+
+    if not args.repos and not args.repos_file and not args.namespace \
+            and not args.all:
+        raise ArgumentException(
+                "Please specify the repositories to {}.".format(action),
+        )
+
+
+def read_repos(args, scanner):
+    repos = list(args.repos)
+    if args.repos_file:
+        repos += [line.strip() for line in args.repos_file if line.strip()]
+    if args.namespace or args.all:
+        repos += scanner.get_repos(args.namespace)
+    return repos
+
+
+def print_ratelimit(wrapper):
+    remaining, limit, reset = wrapper.limiter.status
+    if remaining is not None:
+        print("{}/{} API requests left until {}.".format(
+            remaining, limit, datetime.fromtimestamp(reset).strftime("%X"),
+        ), file=sys.stderr)
+
+
+def create_wrapper(args, repo=None, **kwargs):
+    if args.host in PUBLIC_HOSTS:
+        args.api = PUBLIC_HOSTS[args.host]
+    elif args.host and not args.api:
+        args.api, api_url = detect_api(
+                args.host, os.path.join(args.cache_dir, "hosts.json"),
+                timeout=args.timeout, api_url=args.api_url,
+        )
+        args.api_url = args.api_url or api_url
+
+    if not args.api:
+        raise ArgumentException("Unable to guess API, please specify it.")
+
+    try:
+        service = get_provider(args.api)
+    except KeyError:
+        raise ArgumentException("Unknown API: {}".format(args.api))
+
+    cache = None
+    if not args.no_cache:
+        from libtifu.cache import ResponseCache
+        cache = ResponseCache(
+                args.cache_dir, args.cache_ttl, args.cache_size * 2 ** 20,
+        )
+
+    wrapper = service(
+            repo, args.host, pool_size=args.pool_size, timeout=args.timeout,
+            retries=args.retries, cache=cache, api_url=args.api_url, **kwargs
+    )
+    add_observers(args, wrapper)
+    return wrapper
+
+
+# Options of the APIs, archive and pagination, meaningless for a local clone.
+LOCAL_IGNORED = [
+        "remote", "repo", "api", "host", "api_url", "pool_size", "timeout",
+        "retries", "no_cache", "cache_dir", "cache_ttl", "cache_size", "jobs",
+        "owned", "archive", "offline",
+]
+
+
+def check_local_arguments(parser, args):
+    for dest in LOCAL_IGNORED:
+        if getattr(args, dest) != parser.get_default(dest):
+            option = "A remote" if dest == "remote" \
+                    else "--" + dest.replace("_", "-")
+            raise ArgumentException(
+                    "{} does not apply to --local.".format(option),
+            )
+
+
+def create_local_wrapper(args, **kwargs):
+    from libtifu.generics import APIException
+    from libtifu.local import LocalWrapper
+    try:
+        wrapper = LocalWrapper(args.local, args.push, **kwargs)
+    except APIException as e:
+        raise ArgumentException(e)
+    add_observers(args, wrapper)
+    return wrapper
+
+
+def add_observers(args, wrapper):
+    from libtifu.stats import StatsObserver, TraceObserver
+    if args.stats:
+        wrapper.add_observer(StatsObserver())
+    if args.trace:
+        wrapper.add_observer(TraceObserver(args.trace))
+
+
+def close_observers(wrapper):
+    for observer in wrapper.observers:
+        observer.close()
+
+
+def execute(wrapper):
+    # Exits with an error status when nothing was restored nor listed.
+    try:
+        done = wrapper.execute()
+    finally:
+        close_observers(wrapper)
+    if not done:
+        sys.exit(1)
+
+
+def recover(argv):
+    parser = ArgumentParser(
+            epilog="commands: {} (see tifu.py COMMAND --help)".format(
+                ", ".join(sorted(COMMANDS)),
+            ),
+    )
+    parser.add_argument("remote", nargs="?", help="git remote")
     parser.add_argument(
             "-r", "--repo", metavar="REPO",
             help="repository name (namespace/project)",
     )
-    args = parser.parse_args()
+    add_api_arguments(parser)
+    parser.add_argument(
+            "-j", "--jobs", type=int, default=DEFAULT_JOBS, metavar="N",
+            help="pages fetched in parallel (default: %(default)s)",
+    )
+    parser.add_argument(
+            "--since", type=date, metavar="DATE",
+            help="only list push events after DATE (e.g. 2d, 2017-01-31)",
+    )
+    parser.add_argument(
+            "--until", type=date, metavar="DATE",
+            help="only list push events before DATE",
+    )
+    parser.add_argument(
+            "--owned", action="store_true",
+            help="only list repositories you own or are a member of",
+    )
+    parser.add_argument(
+            "--verify", action="store_true",
+            help="check that the listed push events can still be restored",
+    )
+    parser.add_argument(
+            "--ref", metavar="REF",
+            help="only list push events to REF (e.g. master)",
+    )
+    parser.add_argument(
+            "--sha", metavar="SHA",
+            help="only list push events involving a commit starting with SHA",
+    )
+    parser.add_argument(
+            "--find", metavar="TEXT",
+            help="only list push events with a commit matching a SHA prefix "
+                 "or the words of TEXT (message, author)",
+    )
+    add_archive_arguments(parser)
+    parser.add_argument(
+            "--offline", action="store_true",
+            help="list push events from the archive only",
+    )
+    parser.add_argument(
+            "--local", metavar="PATH",
+            help="list the lost commits of the local clone at PATH (reflogs, "
+                 "unreachable objects) instead of push events",
+    )
+    parser.add_argument(
+            "--push", metavar="REMOTE",
+            help="with --local, also push the restored branch to REMOTE",
+    )
+    parser.add_argument(
+            "--format", choices=["text", "ndjson"], default="text",
+            help="ndjson: write repositories or push events as JSON lines "
+                 "as they are listed, without prompting (default: "
+                 "%(default)s)",
+    )
+    parser.add_argument(
+            "--pick", choices=["latest"],
+            help="restore the most recent force push instead of listing them",
+    )
+    parser.add_argument(
+            "--pick-ref", metavar="REF",
+            help="restore the most recent force push to REF",
+    )
+    parser.add_argument(
+            "--pick-sha", metavar="SHA",
+            help="restore the most recent force push involving a commit "
+                 "starting with SHA",
+    )
+    parser.add_argument(
+            "-y", "--yes", action="store_true",
+            help="restore the picked force push without confirmation",
+    )
+    args = parser.parse_args(argv)
+
+    if args.push and not args.local:
+        raise ArgumentException("--push only applies to --local.")
+
+    picking = args.pick or args.pick_ref or args.pick_sha
+    if args.yes and not picking:
+        raise ArgumentException("--yes only applies to --pick options.")
+
+    output_kwargs = {
+            "output_format": args.format, "pick": args.pick,
+            "pick_ref": args.pick_ref, "pick_sha": args.pick_sha,
+            "yes": args.yes,
+    }
+
+    if args.local:
+        check_local_arguments(parser, args)
+        wrapper = create_local_wrapper(
+                args, since=args.since, until=args.until, verify=args.verify,
+                ref=args.ref, sha=args.sha, find=args.find, **output_kwargs
+        )
+        execute(wrapper)
+        return
+
+    if args.offline and not args.archive:
+        args.archive = DEFAULT_ARCHIVE_PATH
 
     if not args.remote and not args.api and not args.host:
         raise ArgumentException("Please specify at least an API or a remote.")
@@ -48,14 +359,305 @@ def main():
         else:
             raise ArgumentException("Bad remote format.")
 
-    if args.host in ["github.com", "gitlab.com", "bitbucket.org"]:
-        args.api = args.host[:-4]
+    if picking and not args.repo:
+        raise ArgumentException("Please specify the repository to pick from.")
 
-    if not args.api:
-        raise ArgumentException("Unable to guess API, please specify it.")
+    wrapper = create_wrapper(
+            args, args.repo, jobs=args.jobs, since=args.since,
+            verify=args.verify, archive=open_archive(args),
+            offline=args.offline, ref=args.ref, sha=args.sha, find=args.find,
+            until=args.until, owned=args.owned, **output_kwargs
+    )
+    execute(wrapper)
+
+
+def scan(argv):
+    parser = ArgumentParser(
+            prog="tifu.py scan",
+            description="Report force pushes of many repositories as JSON lines.",
+    )
+    add_repos_arguments(parser, "scan")
+    add_api_arguments(parser)
+    parser.add_argument(
+            "-j", "--jobs", type=int, default=DEFAULT_JOBS, metavar="N",
+            help="repositories scanned in parallel (default: %(default)s)",
+    )
+    parser.add_argument(
+            "--since", type=date, default="24h", metavar="DATE",
+            help="only look at push events after DATE (default: %(default)s)",
+    )
+    parser.add_argument(
+            "--until", type=date, metavar="DATE",
+            help="only look at push events before DATE",
+    )
+    parser.add_argument(
+            "--ref", metavar="REF",
+            help="only look at push events to REF (e.g. master)",
+    )
+    parser.add_argument(
+            "--owned", action="store_true",
+            help="with --namespace or --all, only scan repositories you own "
+                 "or are a member of",
+    )
+    parser.add_argument(
+            "--restore", action="store_true",
+            help="create a tifu-<sha> branch for each force push found",
+    )
+    add_archive_arguments(parser)
+    parser.add_argument(
+            "-o", "--output", type=FileType("w"), default="-", metavar="FILE",
+            help="report file (default: stdout)",
+    )
+    args = parser.parse_args(argv)
+
+    check_repos_arguments(args, "scan")
+
+    from libtifu.generics import APIException
+    from libtifu.scan import Scanner
+
+    # Repositories are scanned in parallel rather than their pages.
+    args.pool_size = max(args.pool_size, args.jobs)
+    wrapper = create_wrapper(
+            args, jobs=1, archive=open_archive(args), ref=args.ref,
+            owned=args.owned,
+    )
+    scanner = Scanner(
+            wrapper, args.since, args.restore, args.jobs, args.until,
+    )
+
+    try:
+        wrapper.creds = wrapper.get_creds()
+        repos = read_repos(args, scanner)
+        count = scanner.write_report(repos, args.output)
+    except APIException as e:
+        wrapper.print_failure(e)
+        return
+    finally:
+        close_observers(wrapper)
+    print("{} force push(es) found.".format(count), file=sys.stderr)
+    print_ratelimit(wrapper)
+
+
+def watch(argv):
+    parser = ArgumentParser(
+            prog="tifu.py watch",
+            description="Poll repositories for force pushes and keep a "
+                        "tifu-<sha> branch on the overwritten heads.",
+    )
+    add_repos_arguments(parser, "watch")
+    add_api_arguments(parser)
+    parser.add_argument(
+            "-i", "--interval", type=float, default=DEFAULT_INTERVAL,
+            metavar="SEC",
+            help="seconds between two polls of a repository "
+                 "(default: %(default)s)",
+    )
+    parser.add_argument(
+            "-j", "--jobs", type=int, default=DEFAULT_JOBS, metavar="N",
+            help="repositories polled in parallel (default: %(default)s)",
+    )
+    parser.add_argument(
+            "--since", type=date, metavar="DATE",
+            help="on the first poll, also handle push events after DATE",
+    )
+    parser.add_argument(
+            "--state", default=os.path.join(DEFAULT_CACHE_DIR, "watch.json"),
+            metavar="FILE",
+            help="last seen event of each repository (default: %(default)s)",
+    )
+    parser.add_argument(
+            "--once", action="store_true",
+            help="poll each repository once and exit",
+    )
+    parser.add_argument(
+            "-o", "--output", type=FileType("w"), default="-", metavar="FILE",
+            help="report file (default: stdout)",
+    )
+    args = parser.parse_args(argv)
 
-    wrapper = SERVICES[args.api](args.repo, args.host)
-    wrapper.execute()
+    check_repos_arguments(args, "watch")
+
+    from libtifu.generics import APIException
+    from libtifu.scan import Scanner
+    from libtifu.watch import Watcher
+
+    args.pool_size = max(args.pool_size, args.jobs)
+    wrapper = create_wrapper(args, jobs=1)
+    os.makedirs(os.path.dirname(os.path.abspath(args.state)), exist_ok=True)
+
+    try:
+        wrapper.creds = wrapper.get_creds()
+        repos = read_repos(args, Scanner(wrapper))
+        watcher = Watcher(
+                wrapper, repos, args.interval, args.jobs, args.since,
+                args.state,
+        )
+        print("Watching {} repositories.".format(len(repos)), file=sys.stderr)
+        watcher.run(args.output, args.once)
+    except APIException as e:
+        wrapper.print_failure(e)
+        return
+    finally:
+        close_observers(wrapper)
+    print_ratelimit(wrapper)
+
+
+def restore(argv):
+    parser = ArgumentParser(
+            prog="tifu.py restore",
+            description="Create branches on many commits at once and report "
+                        "the outcome of each one as JSON lines.",
+    )
+    parser.add_argument(
+            "targets", type=FileType("r"), metavar="FILE",
+            help="scan report or lines of REPO SHA [BRANCH] (- for stdin)",
+    )
+    add_api_arguments(parser)
+    parser.add_argument(
+            "-j", "--jobs", type=int, default=DEFAULT_JOBS, metavar="N",
+            help="requests sent in parallel (default: %(default)s)",
+    )
+    parser.add_argument(
+            "-o", "--output", type=FileType("w"), default="-", metavar="FILE",
+            help="report file (default: stdout)",
+    )
+    args = parser.parse_args(argv)
+
+    if not args.api and not args.host:
+        raise ArgumentException("Please specify at least an API or a host.")
+
+    from libtifu.generics import APIException
+    from libtifu.restore import read_targets, write_report
+
+    try:
+        targets = read_targets(args.targets)
+    except ValueError as e:
+        raise ArgumentException(e)
+
+    args.pool_size = max(args.pool_size, args.jobs)
+    wrapper = create_wrapper(args, jobs=args.jobs)
+
+    try:
+        wrapper.creds = wrapper.get_creds()
+        count = write_report(wrapper, targets, args.output)
+    except APIException as e:
+        wrapper.print_failure(e)
+        return
+    finally:
+        close_observers(wrapper)
+    print("{}/{} branch(es) restored.".format(count, len(targets)), file=sys.stderr)
+    print_ratelimit(wrapper)
+
+
+def serve(argv):
+    parser = ArgumentParser(
+            prog="tifu.py serve",
+            description="Serve push events, commit checks and restores as a "
+                        "JSON HTTP API, with the credentials given at start.",
+    )
+    add_api_arguments(parser)
+    parser.add_argument(
+            "-b", "--bind", default="127.0.0.1", metavar="ADDRESS",
+            help="address to listen on (default: %(default)s)",
+    )
+    parser.add_argument(
+            "-p", "--port", type=int, default=DEFAULT_PORT,
+            help="port to listen on (default: %(default)s)",
+    )
+    parser.add_argument(
+            "-w", "--workers", type=int, default=DEFAULT_WORKERS, metavar="N",
+            help="requests handled in parallel (default: %(default)s)",
+    )
+    parser.add_argument(
+            "-j", "--jobs", type=int, default=DEFAULT_JOBS, metavar="N",
+            help="pages fetched in parallel by each request "
+                 "(default: %(default)s)",
+    )
+    parser.add_argument(
+            "--events-ttl", type=float, default=DEFAULT_EVENTS_TTL,
+            metavar="SEC",
+            help="reuse a listing of push events for SEC seconds "
+                 "(default: %(default)s)",
+    )
+    parser.add_argument(
+            "--commits-ttl", type=float, default=DEFAULT_COMMITS_TTL,
+            metavar="SEC",
+            help="forget known commits and compares after SEC seconds "
+                 "(default: %(default)s)",
+    )
+    parser.add_argument(
+            "--secret-file", metavar="FILE",
+            help="require the secret read from FILE as a bearer token, "
+                 "mandatory to listen on other than a loopback address",
+    )
+    parser.add_argument(
+            "-q", "--quiet", action="store_true",
+            help="do not log requests",
+    )
+    args = parser.parse_args(argv)
+
+    if not args.api and not args.host:
+        raise ArgumentException("Please specify at least an API or a host.")
+
+    from libtifu.generics import APIException
+    from libtifu.server import RecoveryServer, is_loopback
+
+    secret = None
+    if args.secret_file:
+        try:
+            with open(args.secret_file) as f:
+                secret = f.read().strip()
+        except OSError as e:
+            raise ArgumentException(e)
+        if not secret:
+            raise ArgumentException("The secret file is empty.")
+    if not secret and not is_loopback(args.bind):
+        raise ArgumentException(
+                "Restores would be open to anyone, please give a "
+                "--secret-file to listen on {}.".format(args.bind)
+        )
+
+    # Every worker shares the connection pool of the wrapper.
+    args.pool_size = max(args.pool_size, args.workers * args.jobs)
+    wrapper = create_wrapper(args, jobs=args.jobs)
+
+    try:
+        wrapper.creds = wrapper.get_creds()
+        print("Authenticated as user {}.".format(wrapper.get_user()), file=sys.stderr)
+        server = RecoveryServer(
+                wrapper, (args.bind, args.port), args.workers,
+                args.events_ttl, args.quiet, args.commits_ttl, secret,
+        )
+    except APIException as e:
+        close_observers(wrapper)
+        wrapper.print_failure(e)
+        return
+    except OSError as e:
+        close_observers(wrapper)
+        raise ArgumentException(e)
+    print("Serving on {}".format(server.url), file=sys.stderr)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        close_observers(wrapper)
+        print_ratelimit(wrapper)
+
+
+COMMANDS = {
+        "restore": restore,
+        "scan": scan,
+        "serve": serve,
+        "watch": watch,
+}
+
+
+def main():
+    argv = sys.argv[1:]
+    if argv and argv[0] in COMMANDS:
+        COMMANDS[argv[0]](argv[1:])
+    else:
+        recover(argv)
 
 
 if __name__ == "__main__":
@@ -63,5 +665,6 @@ if __name__ == "__main__":
         main()
     except ArgumentException as e:
         print(e)
+        sys.exit(2)
     except (KeyboardInterrupt, EOFError):
         print("\nInterrupted")